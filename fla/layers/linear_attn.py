@@ -5,12 +5,10 @@ from typing import Optional
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from einops import rearrange, repeat
 
 from fla.modules import RMSNorm
-from fla.modules.feature_map import DPFPFeatureMap, HadamardFeatureMap, HedgehogFeatureMap, T2RFeatureMap
-from fla.ops.linear_attn import chunk_linear_attn, fused_chunk_linear_attn, fused_recurrent_linear_attn
+from fla.modules.feature_map import DPFPFeatureMap, ELUFeatureMap, HadamardFeatureMap, HedgehogFeatureMap, T2RFeatureMap
+from fla.ops.linear_attn import chunk_linear_attn, featmap_norm, fused_chunk_linear_attn, fused_recurrent_linear_attn
 
 
 class LinearAttention(nn.Module):
@@ -51,6 +49,9 @@ class LinearAttention(nn.Module):
 
         self.head_k_dim = self.key_dim // num_heads
         self.head_v_dim = self.value_dim // num_heads
+        self.feature_map = feature_map
+        # parameter-free feature maps are fused with the L1 normalization into a single pass
+        self.fuse_feature_map_norm = feature_map in ['elu', 'relu', 'identity']
         self.do_feature_map_norm = do_feature_map_norm
 
         if feature_map == 'hedgehog':
@@ -79,10 +80,8 @@ class LinearAttention(nn.Module):
             self.feature_map_k = DPFPFeatureMap(head_dim=self.head_k_dim)
 
         elif feature_map == 'elu':
-            def elu(x):
-                return F.elu(x) + 1
-            self.feature_map_q = elu
-            self.feature_map_k = elu
+            self.feature_map_q = ELUFeatureMap()
+            self.feature_map_k = ELUFeatureMap()
 
         elif feature_map == 'relu':
             self.feature_map_q = nn.ReLU()
@@ -94,9 +93,11 @@ class LinearAttention(nn.Module):
         else:
             raise NotImplementedError(f"Not supported feature map `{feature_map}`.")
 
-        self.q_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
-        self.k_proj = nn.Linear(hidden_size, self.key_dim_per_group, bias=False)
-        self.v_proj = nn.Linear(hidden_size, self.value_dim_per_group, bias=False)
+        self.qkv_proj = nn.Linear(
+            hidden_size,
+            self.key_dim + self.key_dim_per_group + self.value_dim_per_group,
+            bias=False
+        )
 
         if output_norm == 'rmsnorm':
             self.norm = RMSNorm(hidden_size=self.head_v_dim, elementwise_affine=elementwise_affine, eps=norm_eps)
@@ -104,37 +105,53 @@ class LinearAttention(nn.Module):
             self.norm = nn.Identity()
         else:
             raise NotImplementedError(f"Not supported output norm `{output_norm}`.")
+        self._norm_is_identity = isinstance(self.norm, nn.Identity)
 
         self.o_proj = nn.Linear(self.value_dim, hidden_size, bias=False)
 
         self.norm_q = norm_q
         self.norm_k = norm_k
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the fused `qkv_proj` store separate q/k/v projections
+        keys = [f'{prefix}{name}_proj.weight' for name in ('q', 'k', 'v')]
+        if f'{prefix}qkv_proj.weight' not in state_dict and all(key in state_dict for key in keys):
+            state_dict[f'{prefix}qkv_proj.weight'] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
         **kwargs
     ) -> torch.Tensor:
         mode = self.mode
-        q = self.q_proj(hidden_states)
-        k = self.k_proj(hidden_states)
-        v = self.v_proj(hidden_states)
+        q, k, v = self.qkv_proj(hidden_states).split(
+            [self.key_dim, self.key_dim_per_group, self.value_dim_per_group],
+            dim=-1
+        )
 
-        q = rearrange(q, '... (h d) -> ... h d', d=self.head_k_dim)
-        if self.num_kv_groups > 1:
-            k = repeat(k, '... (h d) -> ... (h g) d', d=self.head_k_dim, g=self.num_kv_groups)
-            v = repeat(v, '... (h d) -> ... (h g) d', d=self.head_v_dim, g=self.num_kv_groups)
-        else:
-            k = rearrange(k, '... (h d) -> ... h d', d=self.head_k_dim)
-            v = rearrange(v, '... (h d) -> ... h d', d=self.head_v_dim)
+        q = q.view(*q.shape[:-1], self.num_heads, self.head_k_dim)
+        k = k.view(*k.shape[:-1], self.num_kv_heads, self.head_k_dim)
+        v = v.view(*v.shape[:-1], self.num_kv_heads, self.head_v_dim)
 
-        q = self.feature_map_q(q)
-        k = self.feature_map_k(k)
+        if self.norm_q and self.fuse_feature_map_norm:
+            q = featmap_norm(q, self.feature_map)
+        else:
+            q = self.feature_map_q(q)
+            if self.norm_q:
+                q = q / (q.sum(-1, True) + 1e-4)
+        if self.norm_k and self.fuse_feature_map_norm:
+            k = featmap_norm(k, self.feature_map)
+        else:
+            k = self.feature_map_k(k)
+            if self.norm_k:
+                k = k / (k.sum(-1, True) + 1e-4)
 
-        if self.norm_q:
-            q = q / (q.sum(-1, True) + 1e-4)
-        if self.norm_k:
-            k = k / (k.sum(-1, True) + 1e-4)
+        # the feature maps act on each head independently, so we only broadcast the shared kv heads afterwards,
+        # expanding along a stride-0 group axis and materializing the copy once when flattening into query heads
+        if self.num_kv_groups > 1:
+            k = k.unsqueeze(-2).expand(*k.shape[:-1], self.num_kv_groups, k.shape[-1]).flatten(-3, -2)
+            v = v.unsqueeze(-2).expand(*v.shape[:-1], self.num_kv_groups, v.shape[-1]).flatten(-3, -2)
 
         if mode == 'chunk':
             o, final_state = chunk_linear_attn(
@@ -159,7 +176,8 @@ class LinearAttention(nn.Module):
             )
         else:
             raise NotImplementedError
-        o = self.norm(o)
-        o = rearrange(o, '... h d -> ... (h d)')
+        if not self._norm_is_identity:
+            o = self.norm(o)
+        o = o.flatten(-2)
         o = self.o_proj(o)
         return o
@@ -245,6 +245,22 @@ class RebasedFeatureMap(nn.Module):
         return torch.cat([x2_2 * self.head_dim ** -0.5, x2_1 * (2 / self.head_dim) ** 0.5], dim=-1)
 
 
+@torch.compile
+def elu_p1(x):
+    return F.elu(x) + 1
+
+
+class ELUFeatureMap(nn.Module):
+
+    def __init__(
+        self,
+    ) -> ELUFeatureMap:
+        super().__init__()
+
+    def forward(self, x: torch.Tensor):
+        return elu_p1(x)
+
+
 class ReLUFeatureMap(nn.Module):
 
     def __init__(
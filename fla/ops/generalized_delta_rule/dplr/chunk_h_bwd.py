@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2023-2025, Songlin Yang, Yu Zhang
 
+import math
+import os
 from typing import Optional, Tuple
 
 import torch
@@ -9,9 +11,65 @@ import triton.language as tl
 
 from fla.ops.utils import prepare_chunk_indices, prepare_chunk_offsets
 from fla.ops.utils.op import exp
-from fla.utils import check_shared_mem, is_amd, use_cuda_graph
+from fla.utils import check_shared_mem, get_multiprocessor_count, is_amd, use_cuda_graph
 
 NUM_WARPS_AUTOTUNE = [2, 4, 8, 16] if is_amd else [2, 4, 8, 16, 32]
+# reusing `dh`/`dv2` across backward calls is only safe if they are issued in order from a single stream
+USE_DHU_WORKSPACE = os.environ.get('FLA_USE_DHU_WORKSPACE', '0') == '1'
+DHU_WORKSPACE = {}
+
+
+def get_dhu_workspace(name: str, shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    # the flat buffer only grows so that varying numbers of chunks (e.g., varlen inputs) share one allocation
+    numel = math.prod(shape)
+    buffer = DHU_WORKSPACE.get((name, dtype, device))
+    if buffer is None or buffer.numel() < numel:
+        buffer = DHU_WORKSPACE[(name, dtype, device)] = torch.empty(numel, dtype=dtype, device=device)
+    return buffer[:numel].view(shape)
+
+
+@triton.heuristics({
+    'IS_VARLEN': lambda args: args['cu_seqlens'] is not None,
+})
+@triton.autotune(
+    configs=[
+        triton.Config({}, num_warps=num_warps)
+        for num_warps in [1, 2, 4]
+    ],
+    key=['BT', 'BH', 'BK'],
+    use_cuda_graph=use_cuda_graph,
+)
+@triton.jit(do_not_specialize=['T'])
+def chunk_dplr_bwd_kernel_bg_last_exp(
+    gk,
+    bg_last_exp,
+    cu_seqlens,
+    chunk_indices,
+    T,
+    H: tl.constexpr,
+    K: tl.constexpr,
+    BT: tl.constexpr,
+    BH: tl.constexpr,
+    BK: tl.constexpr,
+    IS_VARLEN: tl.constexpr,
+):
+    i_t, i_b = tl.program_id(0), tl.program_id(1)
+    i_tg = i_t
+    if IS_VARLEN:
+        i_n, i_t = tl.load(chunk_indices + i_t * 2).to(tl.int32), tl.load(chunk_indices + i_t * 2 + 1).to(tl.int32)
+        bos, eos = tl.load(cu_seqlens + i_n).to(tl.int32), tl.load(cu_seqlens + i_n + 1).to(tl.int32)
+        T = eos - bos
+    else:
+        i_tg = i_b * tl.cdiv(T, BT) + i_t
+        bos, eos = i_b * T, i_b * T + T
+
+    # the last position of a chunk is contiguous over all heads, so it is loaded as a single [BH, BK] tile
+    o_h, o_k = tl.arange(0, BH), tl.arange(0, BK)
+    o_hk = o_h[:, None] * K + o_k[None, :]
+    m_hk = (o_h < H)[:, None] & (o_k < K)[None, :]
+    last_idx = min((i_t + 1) * BT, T) - 1
+    b_bg_last = tl.load(gk + (bos + last_idx) * H*K + o_hk, mask=m_hk, other=0).to(tl.float32)
+    tl.store(bg_last_exp + i_tg * H*K + o_hk, exp(b_bg_last), mask=m_hk)
 
 
 @triton.heuristics({
@@ -33,7 +91,7 @@ def chunk_dplr_bwd_kernel_dhu(
     qg,
     bg,
     w,
-    gk,
+    bg_last_exp,
     dht,
     dh0,
     do,
@@ -53,6 +111,7 @@ def chunk_dplr_bwd_kernel_dhu(
     USE_FINAL_STATE_GRADIENT: tl.constexpr,
     USE_INITIAL_STATE: tl.constexpr,
     IS_VARLEN: tl.constexpr,
+    SAFE: tl.constexpr,
 ):
     i_k, i_v, i_nh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
     i_n, i_h = i_nh // H, i_nh % H
@@ -65,6 +124,7 @@ def chunk_dplr_bwd_kernel_dhu(
         bos, eos = i_n * T, i_n * T + T
         NT = tl.cdiv(T, BT)
         boh = i_n * NT
+    bos_k, bos_v = (bos * H + i_h) * K, (bos * H + i_h) * V
 
     # [BK, BV]
     b_dh = tl.zeros([BK, BV], dtype=tl.float32)
@@ -72,34 +132,64 @@ def chunk_dplr_bwd_kernel_dhu(
         p_dht = tl.make_block_ptr(dht + i_nh * K*V, (K, V), (V, 1), (i_k * BK, i_v * BV), (BK, BV), (1, 0))
         b_dh += tl.load(p_dht, boundary_check=(0, 1))
 
+    # sub-chunks are visited contiguously backwards across all chunks,
+    # so the block pointers start at the last sub-chunk and only step back by BC afterwards
+    # `order` mirrors the memory strides (qg/w are read transposed); the compiler picks swizzled
+    # shared-memory layouts for the `tl.dot` operands itself
+    i_s = (NT - 1) * BT + (tl.cdiv(BT, BC) - 1) * BC
+    p_qg = tl.make_block_ptr(qg + bos_k, (K, T), (1, H*K), (i_k * BK, i_s), (BK, BC), (0, 1))
+    p_bg = tl.make_block_ptr(bg + bos_k, (T, K), (H*K, 1), (i_s, i_k * BK), (BC, BK), (1, 0))
+    p_w = tl.make_block_ptr(w + bos_k, (K, T), (1, H*K), (i_k * BK, i_s), (BK, BC), (0, 1))
+    p_dv = tl.make_block_ptr(dv + bos_v, (T, V), (H*V, 1), (i_s, i_v * BV), (BC, BV), (1, 0))
+    p_do = tl.make_block_ptr(do + bos_v, (T, V), (H*V, 1), (i_s, i_v * BV), (BC, BV), (1, 0))
+    p_dv2 = tl.make_block_ptr(dv2 + bos_v, (T, V), (H*V, 1), (i_s, i_v * BV), (BC, BV), (1, 0))
+
     mask_k = tl.arange(0, BK) < K
     for i_t in range(NT - 1, -1, -1):
         p_dh = tl.make_block_ptr(dh + ((boh+i_t) * H + i_h) * K*V, (K, V), (V, 1), (i_k * BK, i_v * BV), (BK, BV), (1, 0))
-        tl.store(p_dh, b_dh.to(p_dh.dtype.element_ty), boundary_check=(0, 1))
+        if SAFE:
+            tl.store(p_dh, b_dh.to(p_dh.dtype.element_ty))
+        else:
+            tl.store(p_dh, b_dh.to(p_dh.dtype.element_ty), boundary_check=(0, 1))
+        # `b_dh` stays in fp32 and is only updated after the inner loop,
+        # so its low-precision copy used as the `tl.dot` operand is cast once per chunk
+        b_dh_lp = b_dh.to(bg.dtype.element_ty)
         b_dh_tmp = tl.zeros([BK, BV], dtype=tl.float32)
-        for i_c in range(tl.cdiv(BT, BC) - 1, -1, -1):
-            p_qg = tl.make_block_ptr(qg+(bos*H+i_h)*K, (K, T), (1, H*K), (i_k * BK, i_t * BT + i_c * BC), (BK, BC), (0, 1))
-            p_bg = tl.make_block_ptr(bg+(bos*H+i_h)*K, (T, K), (H*K, 1), (i_t * BT + i_c * BC, i_k * BK), (BC, BK), (1, 0))
-            p_w = tl.make_block_ptr(w+(bos*H+i_h)*K, (K, T), (1, H*K), (i_k * BK, i_t * BT + i_c * BC), (BK, BC), (0, 1))
-            p_dv = tl.make_block_ptr(dv+(bos*H+i_h)*V, (T, V), (H*V, 1), (i_t*BT + i_c * BC, i_v * BV), (BC, BV), (1, 0))
-            p_do = tl.make_block_ptr(do+(bos*H+i_h)*V, (T, V), (H*V, 1), (i_t*BT + i_c * BC, i_v * BV), (BC, BV), (1, 0))
-            p_dv2 = tl.make_block_ptr(dv2+(bos*H+i_h)*V, (T, V), (H*V, 1), (i_t*BT + i_c * BC, i_v * BV), (BC, BV), (1, 0))
-            # [BK, BT]
-            b_qg = tl.load(p_qg, boundary_check=(0, 1))
-            # [BT, BK]
-            b_bg = tl.load(p_bg, boundary_check=(0, 1))
-            b_w = tl.load(p_w, boundary_check=(0, 1))
-            # [BT, V]
-            b_do = tl.load(p_do, boundary_check=(0, 1))
-            b_dv = tl.load(p_dv, boundary_check=(0, 1))
-            b_dv2 = b_dv + tl.dot(b_bg, b_dh.to(b_bg.dtype))
-            tl.store(p_dv2, b_dv2.to(p_dv.dtype.element_ty), boundary_check=(0, 1))
+        for _ in range(tl.cdiv(BT, BC)):
+            # the [BC] slices are streamed backwards and never revisited by this program,
+            # the other V blocks of the head reuse `qg`/`bg`/`w` through L2, not through this SM's L1
+            # all tiles are in bounds if the shapes are multiples of the block sizes, so the predicates can be dropped
+            if SAFE:
+                # [BK, BT]
+                b_qg = tl.load(p_qg, cache_modifier='.cg')
+                # [BT, BK]
+                b_bg = tl.load(p_bg, cache_modifier='.cg')
+                b_w = tl.load(p_w, cache_modifier='.cg')
+                # [BT, V]
+                b_do = tl.load(p_do, cache_modifier='.cg')
+                b_dv = tl.load(p_dv, cache_modifier='.cg')
+            else:
+                b_qg = tl.load(p_qg, boundary_check=(0, 1), cache_modifier='.cg')
+                b_bg = tl.load(p_bg, boundary_check=(0, 1), cache_modifier='.cg')
+                b_w = tl.load(p_w, boundary_check=(0, 1), cache_modifier='.cg')
+                b_do = tl.load(p_do, boundary_check=(0, 1), cache_modifier='.cg')
+                b_dv = tl.load(p_dv, boundary_check=(0, 1), cache_modifier='.cg')
+            b_dv2 = b_dv + tl.dot(b_bg, b_dh_lp)
+            if SAFE:
+                tl.store(p_dv2, b_dv2.to(p_dv.dtype.element_ty))
+            else:
+                tl.store(p_dv2, b_dv2.to(p_dv.dtype.element_ty), boundary_check=(0, 1))
             # [BK, BV]
             b_dh_tmp += tl.dot(b_qg, b_do.to(b_qg.dtype))
             b_dh_tmp += tl.dot(b_w, b_dv2.to(b_qg.dtype))
-        last_idx = min((i_t + 1) * BT, T) - 1
-        bg_last = tl.load(gk + ((bos + last_idx) * H + i_h) * K + tl.arange(0, BK), mask=mask_k)
-        b_dh *= exp(bg_last)[:, None]
+            p_qg = tl.advance(p_qg, (0, -BC))
+            p_bg = tl.advance(p_bg, (-BC, 0))
+            p_w = tl.advance(p_w, (0, -BC))
+            p_dv = tl.advance(p_dv, (-BC, 0))
+            p_do = tl.advance(p_do, (-BC, 0))
+            p_dv2 = tl.advance(p_dv2, (-BC, 0))
+        b_bg_last_exp = tl.load(bg_last_exp + ((boh + i_t) * H + i_h) * K + tl.arange(0, BK), mask=mask_k, other=0)
+        b_dh *= b_bg_last_exp[:, None]
         b_dh += b_dh_tmp
 
     if USE_INITIAL_STATE:
@@ -117,7 +207,8 @@ def chunk_dplr_bwd_dhu(
     do: torch.Tensor,
     dv: torch.Tensor,
     cu_seqlens: Optional[torch.LongTensor] = None,
-    chunk_size: int = 64
+    chunk_size: int = 64,
+    dh0_dtype: torch.dtype = torch.float32
 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     B, T, H, K, V = *qg.shape, do.shape[-1]
     BT = min(chunk_size, max(triton.next_power_of_2(T), 16))
@@ -125,7 +216,8 @@ def chunk_dplr_bwd_dhu(
     assert BK <= 256, "current kernel does not support head dimension being larger than 256."
     # H100
     if check_shared_mem('hopper', qg.device.index):
-        BV = 64
+        # keep the two fp32 `[BK, BV]` accumulators within 32KB each for large head dims
+        BV = 64 if K <= 128 else 32
         BC = 64 if K <= 128 else 32
     elif check_shared_mem('ampere', qg.device.index):  # A100
         BV = 32
@@ -142,19 +234,48 @@ def chunk_dplr_bwd_dhu(
         N, NT, chunk_offsets = len(cu_seqlens) - 1, len(chunk_indices), prepare_chunk_offsets(cu_seqlens, BT)
 
     BC = min(BT, BC)
+    # columns of `dh` are updated independently along V,
+    # so we shrink BV to launch more programs when there are too few sequences/heads to fill all SMs
+    NS = get_multiprocessor_count(qg.device.index)
+    while BV > 16 and N * H * triton.cdiv(V, BV) < NS:
+        BV //= 2
     NK, NV = triton.cdiv(K, BK), triton.cdiv(V, BV)
     assert NK == 1, 'NK > 1 is not supported because it involves time-consuming synchronization'
 
-    dh = qg.new_empty(B, NT, H, K, V)
-    dh0 = torch.empty_like(h0, dtype=torch.float32) if h0 is not None else None
-    dv2 = torch.zeros_like(dv)
+    # decays of the last position of each chunk are shared by all programs along V, so compute them once upfront
+    bg_last_exp = gk.new_empty(B, NT, H, K, dtype=torch.float)
+    chunk_dplr_bwd_kernel_bg_last_exp[(NT, B)](
+        gk=gk,
+        bg_last_exp=bg_last_exp,
+        cu_seqlens=cu_seqlens,
+        chunk_indices=chunk_indices,
+        T=T,
+        H=H,
+        K=K,
+        BT=BT,
+        BH=triton.next_power_of_2(H),
+        BK=BK,
+    )
+
+    if USE_DHU_WORKSPACE:
+        dh = get_dhu_workspace('dh', (B, NT, H, K, V), qg.dtype, qg.device)
+        dv2 = get_dhu_workspace('dv2', dv.shape, dv.dtype, dv.device)
+    else:
+        dh = qg.new_empty(B, NT, H, K, V)
+        dv2 = torch.empty_like(dv)
+    # `dh0` is accumulated in fp32 inside the kernel, pass `dh0_dtype=h0.dtype` to store it in half precision
+    # the kernel addresses `dh0` as a contiguous `[N, H, K, V]` tensor regardless of the strides of `h0`
+    dh0 = torch.empty_like(h0, dtype=dh0_dtype, memory_format=torch.contiguous_format) if h0 is not None else None
 
+    safe = cu_seqlens is None and T % BT == 0 and K % BK == 0 and V % BV == 0
+
+    # one program per (i_v, i_nh) work item, so that several small-warp programs can share an SM to hide load latency
     grid = (NK, NV, N * H)
     chunk_dplr_bwd_kernel_dhu[grid](
         qg=qg,
         bg=bg,
         w=w,
-        gk=gk,
+        bg_last_exp=bg_last_exp,
         dht=dht,
         dh0=dh0,
         do=do,
@@ -171,5 +292,6 @@ def chunk_dplr_bwd_dhu(
         BC=BC,
         BK=BK,
         BV=BV,
+        SAFE=safe,
     )
     return dh, dh0, dv2
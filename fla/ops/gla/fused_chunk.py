@@ -2,18 +2,20 @@
 # Copyright (c) 2023-2025, Songlin Yang, Yu Zhang
 
 import warnings
-from typing import Tuple
+from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
 import triton
 import triton.language as tl
-from einops import rearrange
 from packaging import version
 
-from fla.ops.utils import chunk_local_cumsum
-from fla.ops.utils.op import exp, safe_exp
-from fla.utils import autocast_custom_bwd, autocast_custom_fwd, input_guard
+from fla.ops.utils.op import exp2, log2
+from fla.utils import autocast_custom_bwd, autocast_custom_fwd, check_shared_mem, device, input_guard
+
+BV_LIST = [32, 64] if check_shared_mem() else [16, 32]
+# tf32 dots are only enabled for Triton>=2.2.0, older versions have known precision issues with these kernels
+ALLOW_TF32 = version.parse(triton.__version__) >= version.parse('2.2.0')
 
 
 @triton.jit(do_not_specialize=['T'])
@@ -21,6 +23,7 @@ def prepare_qg_kg(
     q,
     k,
     g,
+    gc,
     qg,
     kg,
     scale,
@@ -29,30 +32,31 @@ def prepare_qg_kg(
     BT: tl.constexpr,
     BK: tl.constexpr
 ):
-    i_k, i_c, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
-    p_q = q + i_bh * T*K + i_c * BT * K + i_k * BK + tl.arange(0, BK)
-    p_g = g + i_bh * T*K + i_c * BT * K + i_k * BK + tl.arange(0, BK)
-    p_k = k + i_bh * T*K + i_c * BT * K + i_k * BK + tl.arange(0, BK)
-    p_qg = qg + i_bh * T*K + i_c * BT * K + i_k * BK + tl.arange(0, BK)
-    p_kg = kg + i_bh * T*K + i_c * BT * K + i_k * BK + tl.arange(0, BK)
-
-    mask = (i_k * BK + tl.arange(0, BK)) < K
-
-    last_decay = tl.load(g + i_bh * T*K + (i_c * BT + BT - 1) * K + i_k * BK + tl.arange(0, BK))
+    # the cumulative decay is kept in log2 space so that all gates can be evaluated with exp2
+    RCP_LN2: tl.constexpr = 1.4426950216
 
-    for _ in range(BT):
-        b_q = tl.load(p_q, mask=mask, other=0)
-        b_k = tl.load(p_k, mask=mask, other=0)
-        b_g = tl.load(p_g, mask=mask, other=0).to(tl.float32)
-        b_q *= exp(b_g) * scale
-        b_k *= exp(last_decay - b_g)
-        tl.store(p_kg, b_k.to(p_kg.dtype.element_ty), mask=mask)
-        tl.store(p_qg, b_q.to(p_qg.dtype.element_ty), mask=mask)
-        p_q += K
-        p_g += K
-        p_k += K
-        p_kg += K
-        p_qg += K
+    i_k, i_c, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
+    p_q = tl.make_block_ptr(q + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_gc = tl.make_block_ptr(gc + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_qg = tl.make_block_ptr(qg + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_kg = tl.make_block_ptr(kg + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+
+    # [BT, BK]
+    b_q = tl.load(p_q, boundary_check=(0, 1))
+    b_k = tl.load(p_k, boundary_check=(0, 1))
+    b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
+    # chunk-local cumulative decay, kept in float32 to avoid amplifying the accumulated errors
+    b_gc = tl.cumsum(b_g, axis=0) * RCP_LN2
+    # [BK,], equals to the last row of `b_gc` as out-of-bound rows are filled with 0
+    b_gn = tl.sum(b_g, axis=0) * RCP_LN2
+    # fold the scale into the gate, i.e., exp2(g) * scale = exp2(g + log2(scale))
+    b_q = b_q * exp2(b_gc + log2(scale))
+    b_k = b_k * exp2(b_gn[None, :] - b_gc)
+    tl.store(p_gc, b_gc.to(p_gc.dtype.element_ty), boundary_check=(0, 1))
+    tl.store(p_qg, b_q.to(p_qg.dtype.element_ty), boundary_check=(0, 1))
+    tl.store(p_kg, b_k.to(p_kg.dtype.element_ty), boundary_check=(0, 1))
 
 
 @triton.jit(do_not_specialize=['T'])
@@ -71,46 +75,77 @@ def bwd_decay_global_cumsum(
     BK: tl.constexpr
 ):
     i_k, i_c, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
-    p_q = q + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_k = k + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_g = g + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_dg = dg + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_dq_inner = dq_inner + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_dk_inner = dk_inner + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_dq_inter = dq_inter + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    p_dk_inter = dk_inter + i_bh * T*K + i_k * BK + tl.arange(0, BK) + (i_c * BT + BT - 1) * K
-    cum_grad_dg = tl.zeros([BK], dtype=tl.float32)
+    p_q = tl.make_block_ptr(q + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_gn = g + i_bh * T*K + (i_c * BT + BT - 1) * K + i_k * BK + tl.arange(0, BK)
+    p_dg = tl.make_block_ptr(dg + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_dq_inner = tl.make_block_ptr(dq_inner + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_dk_inner = tl.make_block_ptr(dk_inner + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_dq_inter = tl.make_block_ptr(dq_inter + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
+    p_dk_inter = tl.make_block_ptr(dk_inter + i_bh * T*K, (T, K), (K, 1), (i_c * BT, i_k * BK), (BT, BK), (1, 0))
     mask = (i_k * BK + tl.arange(0, BK)) < K
-    last_g = tl.zeros([BK], dtype=tl.float32)
-    for j in range(BT-1, -1, -1):
-        b_g = tl.load(p_g, mask=mask, other=0).to(tl.float32)
-        if j == (BT-1):
-            last_g = b_g
-        b_dq1 = tl.load(p_dq_inner, mask=mask, other=0)
-        b_dq2 = tl.load(p_dq_inter, mask=mask, other=0)
-        b_dq2 *= exp(b_g)
-        b_dq = b_dq1 + b_dq2
-        tl.store(p_dq_inter, b_dq, mask=mask)
-        b_dk1 = tl.load(p_dk_inner, mask=mask, other=0)
-        b_dk2 = tl.load(p_dk_inter, mask=mask, other=0)
-        b_dk2 *= safe_exp(last_g - b_g)
-        b_dk = b_dk1 + b_dk2
-        tl.store(p_dk_inter, b_dk, mask=mask)
-        b_q = tl.load(p_q, mask=mask, other=0)
-        b_k = tl.load(p_k, mask=mask, other=0)
-        b_dg = b_dq * b_q - b_dk * b_k
-        cum_grad_dg += b_dg
-        tl.store(p_dg, cum_grad_dg.to(p_dg.dtype.element_ty), mask=mask)
-        p_g -= K
-        p_k -= K
-        p_q -= K
-        p_dq_inner -= K
-        p_dk_inner -= K
-        p_dq_inter -= K
-        p_dk_inter -= K
-        p_dg -= K
 
+    # [BT, BK]
+    b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
+    # [BK,]
+    b_gn = tl.load(p_gn, mask=mask, other=0).to(tl.float32)
+
+    b_dq = tl.load(p_dq_inner, boundary_check=(0, 1)).to(tl.float32)
+    b_dq += tl.load(p_dq_inter, boundary_check=(0, 1)).to(tl.float32) * exp2(b_g)
+    tl.store(p_dq_inter, b_dq.to(p_dq_inter.dtype.element_ty), boundary_check=(0, 1))
+    b_dk = tl.load(p_dk_inner, boundary_check=(0, 1)).to(tl.float32)
+    b_gk = b_gn[None, :] - b_g
+    b_dk += tl.load(p_dk_inter, boundary_check=(0, 1)).to(tl.float32) * exp2(tl.where(b_gk <= 0, b_gk, float('-inf')))
+    tl.store(p_dk_inter, b_dk.to(p_dk_inter.dtype.element_ty), boundary_check=(0, 1))
 
+    b_q = tl.load(p_q, boundary_check=(0, 1)).to(tl.float32)
+    b_k = tl.load(p_k, boundary_check=(0, 1)).to(tl.float32)
+    b_dg = b_dq * b_q - b_dk * b_k
+    # reverse inclusive cumsum within the chunk
+    b_dg = b_dg - tl.cumsum(b_dg, axis=0) + tl.sum(b_dg, axis=0)[None, :]
+    tl.store(p_dg, b_dg.to(p_dg.dtype.element_ty), boundary_check=(0, 1))
+
+
+@triton.jit(do_not_specialize=['T'])
+def bwd_decay_rev_cumsum_add(
+    dg,
+    dgt,
+    T,
+    K: tl.constexpr,
+    BT: tl.constexpr,
+    BK: tl.constexpr,
+    USE_FINAL_STATE_GRADIENT: tl.constexpr
+):
+    i_k, i_bh = tl.program_id(0), tl.program_id(1)
+    o_k = i_k * BK + tl.arange(0, BK)
+    mask = o_k < K
+
+    # [BK,], sum of the gradients of all subsequent chunks
+    b_acc = tl.zeros([BK], dtype=tl.float32)
+    if USE_FINAL_STATE_GRADIENT:
+        # the final state decays through every step, so its gradient is shared by all of them
+        b_acc += tl.load(dgt + i_bh * K + o_k, mask=mask, other=0).to(tl.float32)
+    for i_t in range(tl.cdiv(T, BT) - 1, -1, -1):
+        p_dg = tl.make_block_ptr(dg + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        # the first row of each chunk holds the total gradient of that chunk
+        b_dgn = tl.load(dg + i_bh * T*K + i_t * BT * K + o_k, mask=mask, other=0).to(tl.float32)
+        b_dg = tl.load(p_dg, boundary_check=(0, 1)).to(tl.float32) + b_acc[None, :]
+        tl.store(p_dg, b_dg.to(p_dg.dtype.element_ty), boundary_check=(0, 1))
+        b_acc += b_dgn
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({'BV': BV}, num_warps=num_warps, num_stages=num_stages)
+        for BV in BV_LIST
+        for num_warps in [1, 2, 4]
+        for num_stages in [1, 2, 3]
+    ],
+    key=['BT', 'BK', 'K', 'V'],
+    # partial outputs of multiple K blocks are accumulated atomically
+    reset_to_zero=['o']
+)
 @triton.jit(do_not_specialize=['T'])
 def fused_chunk_gla_fwd_kernel(
     q,
@@ -121,16 +156,16 @@ def fused_chunk_gla_fwd_kernel(
     h0,
     ht,
     T,
-    B: tl.constexpr,
-    H: tl.constexpr,
     K: tl.constexpr,
     V: tl.constexpr,
     BT: tl.constexpr,
     BK: tl.constexpr,
     BV: tl.constexpr,
+    NK: tl.constexpr,
     USE_INITIAL_STATE: tl.constexpr,
     STORE_FINAL_STATE: tl.constexpr,
-    CHECK: tl.constexpr
+    CHECK: tl.constexpr,
+    ALLOW_TF32: tl.constexpr
 ):
     i_v, i_k, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
 
@@ -141,7 +176,9 @@ def fused_chunk_gla_fwd_kernel(
     p_gn = g + i_bh * T*K + (BT - 1) * K + i_k * BK + tl.arange(0, BK)
     p_k = tl.make_block_ptr(k + i_bh * T*K, (K, T), (1, K), (i_k * BK, 0), (BK, BT), (0, 1))
     p_v = tl.make_block_ptr(v + i_bh * T*V, (T, V), (V, 1), (0, i_v * BV), (BT, BV), (1, 0))
-    p_o = tl.make_block_ptr(o + (i_bh + i_k * B * H) * T*V, (T, V), (V, 1), (0, i_v * BV), (BT, BV), (1, 0))
+    p_o = tl.make_block_ptr(o + i_bh * T*V, (T, V), (V, 1), (0, i_v * BV), (BT, BV), (1, 0))
+    o_t = tl.arange(0, BT)
+    o_v = i_v * BV + tl.arange(0, BV)
 
     if USE_INITIAL_STATE:
         p_h = tl.make_block_ptr(h0 + i_bh * K * V, (K, V), (V, 1), (i_k * BK, i_v * BV), (BK, BV), (1, 0))
@@ -150,21 +187,27 @@ def fused_chunk_gla_fwd_kernel(
     mask = (i_k * BK + tl.arange(0, BK)) < K
 
     for i in range(0, tl.cdiv(T, BT)):
+        # the state is carried from chunk to chunk, so no chunk's tiles are read twice by this program
         # [BK, BT]
-        b_k = tl.load(p_k, boundary_check=(0, 1))
+        b_k = tl.load(p_k, boundary_check=(0, 1), cache_modifier='.cg')
         # [BT, BV]
-        b_v = tl.load(p_v, boundary_check=(0, 1))
+        b_v = tl.load(p_v, boundary_check=(0, 1), cache_modifier='.cg')
         # [BT, BK]
-        b_q = tl.load(p_q, boundary_check=(0, 1))
-        b_gn = tl.load(p_gn, mask=mask, other=0).to(tl.float32)
+        b_q = tl.load(p_q, boundary_check=(0, 1), cache_modifier='.cg')
+        b_gn = tl.load(p_gn, mask=mask, other=0, cache_modifier='.cg').to(tl.float32)
         if CHECK and i == 0:
-            b_o = tl.dot(b_q.to(b_v.dtype), b_h.to(b_v.dtype), allow_tf32=False)
-            b_h = b_h * exp(b_gn)[:, None] + tl.dot(b_k.to(b_v.dtype), b_v, allow_tf32=False)
+            b_o = tl.dot(b_q.to(b_v.dtype), b_h.to(b_v.dtype), allow_tf32=ALLOW_TF32)
+            b_h = b_h * exp2(b_gn)[:, None] + tl.dot(b_k.to(b_v.dtype), b_v, allow_tf32=ALLOW_TF32)
         else:
-            b_o = tl.dot(b_q.to(b_v.dtype), b_h.to(b_v.dtype), allow_tf32=False)
-            b_h = b_h * exp(b_gn)[:, None] + tl.dot(b_k.to(b_v.dtype), b_v, allow_tf32=False)
+            b_o = tl.dot(b_q.to(b_v.dtype), b_h.to(b_v.dtype), allow_tf32=ALLOW_TF32)
+            b_h = b_h * exp2(b_gn)[:, None] + tl.dot(b_k.to(b_v.dtype), b_v, allow_tf32=ALLOW_TF32)
 
-        tl.store(p_o, b_o.to(p_o.dtype.element_ty), boundary_check=(0, 1))
+        if NK > 1:
+            # partial sums over the K blocks are reduced in place into a float32 output
+            m_o = ((i * BT + o_t) < T)[:, None] & (o_v < V)[None, :]
+            tl.atomic_add(o + i_bh * T*V + (i * BT + o_t)[:, None] * V + o_v[None, :], b_o, mask=m_o, sem='relaxed')
+        else:
+            tl.store(p_o, b_o.to(p_o.dtype.element_ty), boundary_check=(0, 1))
         p_q = tl.advance(p_q, (BT, 0))
         p_k = tl.advance(p_k, (0, BT))
         p_v = tl.advance(p_v, (BT, 0))
@@ -177,6 +220,16 @@ def fused_chunk_gla_fwd_kernel(
 
 
 # Similar to Algorithm1 of https://arxiv.org/abs/2006.16236
+@triton.autotune(
+    configs=[
+        triton.Config({}, num_warps=num_warps, num_stages=num_stages)
+        for num_warps in [1, 2, 4]
+        for num_stages in [1, 2, 3]
+    ],
+    key=['BT', 'BK', 'BV', 'K', 'V'],
+    # partial gradients of multiple K/V blocks are accumulated atomically
+    reset_to_zero=['dq', 'dk', 'dv']
+)
 @triton.jit(do_not_specialize=['T'])
 def fused_chunk_gla_bwd_kernel(
     q, k, v, g,
@@ -185,20 +238,29 @@ def fused_chunk_gla_bwd_kernel(
     dk,
     dv,
     h0,
+    dht,
+    dh0,
+    dgt,
     scale,
     T,
-    B: tl.constexpr,
-    H: tl.constexpr,
     K: tl.constexpr,
     V: tl.constexpr,
     # clamp_min, # minimum log value of the gate for numerical stability. default: -5
     BT: tl.constexpr,
     BK: tl.constexpr,
     BV: tl.constexpr,
+    NK: tl.constexpr,
+    NV: tl.constexpr,
     USE_INITIAL_STATE: tl.constexpr,
-    CHECK: tl.constexpr
+    USE_FINAL_STATE_GRADIENT: tl.constexpr,
+    STORE_INITIAL_STATE_GRADIENT: tl.constexpr,
+    CHECK: tl.constexpr,
+    ALLOW_TF32: tl.constexpr
 ):
     i_v, i_k, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
+    o_t = tl.arange(0, BT)
+    o_k = i_k * BK + tl.arange(0, BK)
+    o_v = i_v * BV + tl.arange(0, BV)
     # [BV, BK]
     b_h = tl.zeros([BV, BK], dtype=tl.float32)
 
@@ -208,35 +270,50 @@ def fused_chunk_gla_bwd_kernel(
 
     mask = (i_k * BK + tl.arange(0, BK)) < K
     for i in range(0, tl.cdiv(T, BT)):
+        # the two passes walk the chunks in opposite directions, by the time the reverse pass
+        # gets back to a chunk its tiles are long gone from L1, so neither pass allocates them there
         p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i * BT, i_k * BK), (BT, BK), (1, 0))
         p_gn = g + i_bh * T*K + ((i+1) * BT - 1) * K + i_k * BK + tl.arange(0, BK)
         p_v = tl.make_block_ptr(v + i_bh * T*V, (V, T), (1, V), (i_v * BV, i * BT), (BV, BT), (0, 1))
         p_do = tl.make_block_ptr(do + i_bh * T*V, (T, V), (V, 1), (i * BT, i_v * BV), (BT, BV), (1, 0))
-        p_dq = tl.make_block_ptr(dq + (i_bh+i_v*B*H)*T*K, (T, K), (K, 1), (i * BT, i_k * BK), (BT, BK), (1, 0))
+        p_dq = tl.make_block_ptr(dq + i_bh * T*K, (T, K), (K, 1), (i * BT, i_k * BK), (BT, BK), (1, 0))
         b_dq = tl.zeros([BT, BK], dtype=tl.float32)
         # [BT, K]
-        b_k = tl.load(p_k, boundary_check=(0, 1))
-        b_gn = tl.load(p_gn, mask=mask, other=0).to(tl.float32)
+        b_k = tl.load(p_k, boundary_check=(0, 1), cache_modifier='.cg')
+        b_gn = tl.load(p_gn, mask=mask, other=0, cache_modifier='.cg').to(tl.float32)
 
         # [V, BT]
-        b_v = tl.load(p_v, boundary_check=(0, 1))
+        b_v = tl.load(p_v, boundary_check=(0, 1), cache_modifier='.cg')
         # [BT, V]
-        b_do = tl.load(p_do, boundary_check=(0, 1))
+        b_do = tl.load(p_do, boundary_check=(0, 1), cache_modifier='.cg')
         # [V, K]
         if CHECK and i == 0:
-            b_dq += tl.dot(b_do, b_h.to(b_do.dtype), allow_tf32=False)
-            b_h = b_h * exp(b_gn)[None, :] + tl.dot(b_v, b_k.to(b_v.dtype), allow_tf32=False)
+            b_dq += tl.dot(b_do, b_h.to(b_do.dtype), allow_tf32=ALLOW_TF32)
+            b_h = b_h * exp2(b_gn)[None, :] + tl.dot(b_v, b_k.to(b_v.dtype), allow_tf32=ALLOW_TF32)
         else:
-            b_dq += tl.dot(b_do, b_h.to(b_do.dtype), allow_tf32=False)
-            b_h = b_h * exp(b_gn)[None, :] + tl.dot(b_v, b_k.to(b_v.dtype), allow_tf32=False)
+            b_dq += tl.dot(b_do, b_h.to(b_do.dtype), allow_tf32=ALLOW_TF32)
+            b_h = b_h * exp2(b_gn)[None, :] + tl.dot(b_v, b_k.to(b_v.dtype), allow_tf32=ALLOW_TF32)
         b_dq *= scale
-        tl.store(p_dq, b_dq.to(p_dq.dtype.element_ty), boundary_check=(0, 1))
+        if NV > 1:
+            m_dq = ((i * BT + o_t) < T)[:, None] & (o_k < K)[None, :]
+            tl.atomic_add(dq + i_bh * T*K + (i * BT + o_t)[:, None] * K + o_k[None, :], b_dq, mask=m_dq, sem='relaxed')
+        else:
+            tl.store(p_dq, b_dq.to(p_dq.dtype.element_ty), boundary_check=(0, 1))
+
+    if USE_FINAL_STATE_GRADIENT:
+        # `b_h` holds the final state by now, the partial sums over the V blocks are reduced outside
+        p_dht = tl.make_block_ptr(dht + i_bh * K * V, (V, K), (1, V), (i_v * BV, i_k * BK), (BV, BK), (0, 1))
+        b_dht = tl.load(p_dht, boundary_check=(0, 1)).to(tl.float32)
+        tl.store(dgt + (i_bh * NV + i_v) * K + o_k, tl.sum(b_h * b_dht, 0), mask=o_k < K)
 
     # sync threads
     b_h = None
     tl.debug_barrier()
     # [BK, BV]
     b_dh = tl.zeros([BK, BV], dtype=tl.float32)
+    if USE_FINAL_STATE_GRADIENT:
+        p_dht = tl.make_block_ptr(dht + i_bh * K * V, (K, V), (V, 1), (i_k * BK, i_v * BV), (BK, BV), (1, 0))
+        b_dh += tl.load(p_dht, boundary_check=(0, 1)).to(tl.float32)
 
     # cum = tl.zeros([BK], dtype=tl.float32)
     for i in range(1, tl.cdiv(T, BT) + 1):
@@ -245,120 +322,203 @@ def fused_chunk_gla_bwd_kernel(
         p_gn = g + i_bh * T*K + (T - (i-1) * BT - 1) * K + i_k * BK + tl.arange(0, BK)
         p_v = tl.make_block_ptr(v + i_bh * T*V, (T, V), (V, 1), (T - i * BT, i_v * BV), (BT, BV), (1, 0))
         p_do = tl.make_block_ptr(do + i_bh * T*V, (T, V), (V, 1), (T - i * BT, i_v * BV), (BT, BV), (1, 0))
-        p_dk = tl.make_block_ptr(dk + (i_bh + i_v * B * H) * T*K, (T, K),
-                                 (K, 1), (T - i * BT, i_k * BK), (BT, BK), (1, 0))
-        p_dv = tl.make_block_ptr(dv + (i_bh + i_k * B * H) * T*V, (T, V),
-                                 (V, 1), (T - i * BT, i_v * BV), (BT, BV), (1, 0))
+        p_dk = tl.make_block_ptr(dk + i_bh * T*K, (T, K), (K, 1), (T - i * BT, i_k * BK), (BT, BK), (1, 0))
+        p_dv = tl.make_block_ptr(dv + i_bh * T*V, (T, V), (V, 1), (T - i * BT, i_v * BV), (BT, BV), (1, 0))
         # [K, BT]
-        b_q = tl.load(p_q, boundary_check=(0, 1))
+        b_q = tl.load(p_q, boundary_check=(0, 1), cache_modifier='.cg')
         # [BT, K]
-        b_k = tl.load(p_k, boundary_check=(0, 1))
+        b_k = tl.load(p_k, boundary_check=(0, 1), cache_modifier='.cg')
         # [BT, V]
-        b_v = tl.load(p_v, boundary_check=(0, 1))
-        b_do = tl.load(p_do, boundary_check=(0, 1))
-        b_db = tl.load(p_gn, mask=mask, other=0).to(tl.float32)
+        b_v = tl.load(p_v, boundary_check=(0, 1), cache_modifier='.cg')
+        b_do = tl.load(p_do, boundary_check=(0, 1), cache_modifier='.cg')
+        b_db = tl.load(p_gn, mask=mask, other=0, cache_modifier='.cg').to(tl.float32)
 
         # inter-chunk
         # [K, V]
         if CHECK and i == 1:
-            b_dk = tl.trans(tl.dot(b_dh.to(b_v.dtype), tl.trans(b_v), allow_tf32=False))
-            b_dv = tl.dot((b_k).to(b_v.dtype), b_dh.to(b_v.dtype), allow_tf32=False)
-            b_dh = b_dh * exp(b_db)[:, None] + tl.dot(b_q.to(b_do.dtype), b_do, allow_tf32=False)
+            b_dk = tl.trans(tl.dot(b_dh.to(b_v.dtype), tl.trans(b_v), allow_tf32=ALLOW_TF32))
+            b_dv = tl.dot((b_k).to(b_v.dtype), b_dh.to(b_v.dtype), allow_tf32=ALLOW_TF32)
+            b_dh = b_dh * exp2(b_db)[:, None] + tl.dot(b_q.to(b_do.dtype), b_do, allow_tf32=ALLOW_TF32)
+        else:
+            b_dk = tl.trans(tl.dot(b_dh.to(b_v.dtype), tl.trans(b_v), allow_tf32=ALLOW_TF32))
+            b_dv = tl.dot((b_k).to(b_v.dtype), b_dh.to(b_v.dtype), allow_tf32=ALLOW_TF32)
+            b_dh = b_dh * exp2(b_db)[:, None] + tl.dot(b_q.to(b_do.dtype), b_do, allow_tf32=ALLOW_TF32)
+
+        m_t = (T - i * BT + o_t) < T
+        if NV > 1:
+            tl.atomic_add(dk + i_bh * T*K + (T - i * BT + o_t)[:, None] * K + o_k[None, :], b_dk,
+                          mask=m_t[:, None] & (o_k < K)[None, :], sem='relaxed')
+        else:
+            tl.store(p_dk, b_dk.to(p_dk.dtype.element_ty), boundary_check=(0, 1))
+        if NK > 1:
+            tl.atomic_add(dv + i_bh * T*V + (T - i * BT + o_t)[:, None] * V + o_v[None, :], b_dv,
+                          mask=m_t[:, None] & (o_v < V)[None, :], sem='relaxed')
         else:
-            b_dk = tl.trans(tl.dot(b_dh.to(b_v.dtype), tl.trans(b_v), allow_tf32=False))
-            b_dv = tl.dot((b_k).to(b_v.dtype), b_dh.to(b_v.dtype), allow_tf32=False)
-            b_dh = b_dh * exp(b_db)[:, None] + tl.dot(b_q.to(b_do.dtype), b_do, allow_tf32=False)
+            tl.store(p_dv, b_dv.to(p_dv.dtype.element_ty), boundary_check=(0, 1))
 
-        tl.store(p_dk, b_dk.to(p_dk.dtype.element_ty), boundary_check=(0, 1))
-        tl.store(p_dv, b_dv.to(p_dv.dtype.element_ty), boundary_check=(0, 1))
+    if STORE_INITIAL_STATE_GRADIENT:
+        p_dh0 = tl.make_block_ptr(dh0 + i_bh * K * V, (K, V), (V, 1), (i_k * BK, i_v * BV), (BK, BV), (1, 0))
+        tl.store(p_dh0, b_dh.to(p_dh0.dtype.element_ty), boundary_check=(0, 1))
 
 
 @triton.jit
-def fwd_inner_chunk(
-    q, k, g, A,
-    scale,  # K ** -0.5
-    B: tl.constexpr,  # B
-    H: tl.constexpr,  # H
-    T,  # T
-    K: tl.constexpr,  # K
-    BT: tl.constexpr,  # BLOCK SIZE along the sequence dimension, a.k.a. chunk size
-    BK: tl.constexpr  # BLOCK SIZE along the K dimension
+def inner_chunk_decay(
+    g,
+    b_g,
+    scale,
+    i_t,
+    i_bh,
+    i_k,
+    T,
+    K: tl.constexpr,
+    BT: tl.constexpr,
+    BK: tl.constexpr,
+    S: tl.constexpr
 ):
-
-    i_k, i_t, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
-
-    p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
-    p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
-
-    b_k = tl.load(p_k, boundary_check=(0, 1))
-    b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
-
-    mask = (i_k * BK + tl.arange(0, BK)) < K
+    # the causal pairs i > j of a chunk are grouped by the highest bit in which i and j differ,
+    # i.e., the pairs of a level lie in the same block of 2*S rows, with i in the upper half and j in the lower one.
+    # all of them share the first row of the upper half as the pivot r, so the decay is factorized as
+    # exp2(g_i - g_r) * exp2(g_r - g_j), where both factors are at most 1 as g_i <= g_r <= g_j
     o_i = tl.arange(0, BT)
+    o_k = i_k * BK + tl.arange(0, BK)
+    # [BT,]
+    o_r = o_i // (2 * S) * (2 * S) + S
+    m_r = (i_t * BT + o_r) < T
+    # [BT, BK]
+    b_gr = tl.load(g + i_bh * T*K + (i_t * BT + o_r)[:, None] * K + o_k[None, :],
+                   mask=m_r[:, None] & (o_k < K)[None, :], other=0).to(tl.float32)
+    b_gq = b_g - b_gr
+    b_gk = b_gr - b_g
+    # rows of the upper halves only act as queries and rows of the lower halves only as keys,
+    # the scale is folded into the query side, i.e., exp2(g) * scale = exp2(g + log2(scale))
+    b_fq = exp2(tl.where((o_i >= o_r)[:, None] & (b_gq <= 0), b_gq, float('-inf')) + log2(scale))
+    b_fk = exp2(tl.where((o_i < o_r)[:, None] & (b_gk <= 0), b_gk, float('-inf')))
+    # [BT, BT]
+    m_s = (o_i[:, None] // (2 * S)) == (o_i[None, :] // (2 * S))
+    return b_fq, b_fk, m_s
 
-    p_q = q + i_bh * T*K + i_k * BK + i_t * BT * K + tl.arange(0, BK)
-    p_gq = g + i_bh * T*K + i_k * BK + i_t * BT * K + tl.arange(0, BK)
-    p_A = A + (i_bh + (i_k * B * H)) * (tl.cdiv(T, BT) * BT * BT) + i_t * BT * BT + tl.arange(0, BT)
 
-    for i in range(BT):
-        b_q = tl.load(p_q, mask=mask, other=0) * scale
-        b_gq = tl.load(p_gq, mask=mask, other=0).to(tl.float32)
-        s = b_q[None, :] * b_k * safe_exp(b_gq[None, :] - b_g)
-        score = tl.sum(s, axis=1)
-        score = tl.where(o_i <= i, score, 0)
-        tl.store(p_A, score.to(p_A.dtype.element_ty))
-        p_q += K
-        p_gq += K
-        p_A += BT
+@triton.jit(do_not_specialize=['T'])
+def fwd_inner_chunk(
+    q,
+    k,
+    v,
+    g,
+    o,
+    scale,
+    T,
+    K: tl.constexpr,
+    V: tl.constexpr,
+    BT: tl.constexpr,
+    BK: tl.constexpr,
+    BV: tl.constexpr
+):
+    i_t, i_bh = tl.program_id(0), tl.program_id(1)
+    o_i = tl.arange(0, BT)
+    # one level per bit of the row index
+    NS: tl.constexpr = tl.standard._log2(BT)
+
+    # [BT, BT]
+    b_A = tl.zeros([BT, BT], dtype=tl.float32)
+    for i_k in range(tl.cdiv(K, BK)):
+        p_q = tl.make_block_ptr(q + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        # [BT, BK]
+        b_q = tl.load(p_q, boundary_check=(0, 1)).to(tl.float32)
+        b_k = tl.load(p_k, boundary_check=(0, 1)).to(tl.float32)
+        b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
+        # the diagonal is not decayed at all, so there is no exp2 to fold the scale into
+        b_A += tl.where(o_i[:, None] == o_i[None, :], tl.sum(b_q * b_k, 1)[:, None] * scale, 0.)
+        for i_s in tl.static_range(NS):
+            b_fq, b_fk, m_s = inner_chunk_decay(g, b_g, scale, i_t, i_bh, i_k, T, K, BT, BK, 2 ** i_s)
+            b_A += tl.where(m_s, tl.dot(b_q * b_fq, tl.trans(b_k * b_fk)), 0.)
+
+    # the intra-chunk outputs are added to the inter-chunk ones in place
+    for i_v in range(tl.cdiv(V, BV)):
+        p_v = tl.make_block_ptr(v + i_bh * T*V, (T, V), (V, 1), (i_t * BT, i_v * BV), (BT, BV), (1, 0))
+        p_o = tl.make_block_ptr(o + i_bh * T*V, (T, V), (V, 1), (i_t * BT, i_v * BV), (BT, BV), (1, 0))
+        # [BT, BV]
+        b_v = tl.load(p_v, boundary_check=(0, 1))
+        b_o = tl.load(p_o, boundary_check=(0, 1)).to(tl.float32)
+        b_o += tl.dot(b_A.to(b_v.dtype), b_v)
+        tl.store(p_o, b_o.to(p_o.dtype.element_ty), boundary_check=(0, 1))
 
 
-@triton.jit
+@triton.jit(do_not_specialize=['T'])
 def bwd_inner_chunk(
     q,
     k,
+    v,
     g,
-    dA,
+    do,
     dq,
     dk,
-    T,  # T
-    K: tl.constexpr,  # K
-    # clamp_min, # minimum log value of the gate for numerical stability. default: -5
-    BT: tl.constexpr,  # BLOCK SIZE along the sequence dimension, a.k.a. chunk size
-    BK: tl.constexpr,  # BLOCK SIZE along the K dimension
+    dv,
+    scale,
+    T,
+    K: tl.constexpr,
+    V: tl.constexpr,
+    BT: tl.constexpr,
+    BK: tl.constexpr,
+    BV: tl.constexpr
 ):
-    i_k, i_t, i_bh = tl.program_id(0), tl.program_id(1), tl.program_id(2)
-    p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
-    b_k = tl.load(p_k, boundary_check=(0, 1))
-    p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
-    b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
-
-    mask = (i_k * BK + tl.arange(0, BK)) < K
+    i_t, i_bh = tl.program_id(0), tl.program_id(1)
     o_i = tl.arange(0, BT)
-
-    p_q = q + i_bh * T*K + i_k * BK + i_t * BT * K + tl.arange(0, BK)
-    p_dq = dq + (i_bh) * T*K + i_k * BK + i_t * BT * K + tl.arange(0, BK)
-    p_gq = g + i_bh * T*K + i_k * BK + i_t * BT * K + tl.arange(0, BK)
-    p_dA = dA + i_bh * (tl.cdiv(T, BT) * BT * BT) + i_t * BT * BT + tl.arange(0, BT)
-
-    b_dk = tl.zeros([BT, BK], dtype=tl.float32)
-
-    for i in range(BT):
-        b_q = tl.load(p_q, mask=mask, other=0)
-        b_gq = tl.load(p_gq, mask=mask, other=0).to(tl.float32)
-        score = safe_exp(b_gq[None, :] - b_g)
-        score = tl.where(o_i[:, None] <= i, score, 0)
-        b_dA = tl.load(p_dA)
-        b_dA = tl.where(o_i <= i, b_dA, 0)
-        b_dk += (b_dA[:, None] * score * b_q[None, :])
-        b_dq = tl.sum(b_dA[:, None] * score * b_k, axis=0)
-        tl.store(p_dq, b_dq, mask=mask)
-        p_q += K
-        p_dq += K
-        p_gq += K
-        p_dA += BT
-
-    p_dk = tl.make_block_ptr(dk + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
-    tl.store(p_dk, b_dk.to(dk.dtype.element_ty), boundary_check=(0, 1))
+    NS: tl.constexpr = tl.standard._log2(BT)
+
+    # recompute the intra-chunk scores rather than keeping them alive from the forward pass
+    # [BT, BT]
+    b_A = tl.zeros([BT, BT], dtype=tl.float32)
+    for i_k in range(tl.cdiv(K, BK)):
+        p_q = tl.make_block_ptr(q + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        b_q = tl.load(p_q, boundary_check=(0, 1)).to(tl.float32)
+        b_k = tl.load(p_k, boundary_check=(0, 1)).to(tl.float32)
+        b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
+        b_A += tl.where(o_i[:, None] == o_i[None, :], tl.sum(b_q * b_k, 1)[:, None] * scale, 0.)
+        for i_s in tl.static_range(NS):
+            b_fq, b_fk, m_s = inner_chunk_decay(g, b_g, scale, i_t, i_bh, i_k, T, K, BT, BK, 2 ** i_s)
+            b_A += tl.where(m_s, tl.dot(b_q * b_fq, tl.trans(b_k * b_fk)), 0.)
+
+    b_dA = tl.zeros([BT, BT], dtype=tl.float32)
+    for i_v in range(tl.cdiv(V, BV)):
+        p_v = tl.make_block_ptr(v + i_bh * T*V, (T, V), (V, 1), (i_t * BT, i_v * BV), (BT, BV), (1, 0))
+        p_do = tl.make_block_ptr(do + i_bh * T*V, (T, V), (V, 1), (i_t * BT, i_v * BV), (BT, BV), (1, 0))
+        p_dv = tl.make_block_ptr(dv + i_bh * T*V, (T, V), (V, 1), (i_t * BT, i_v * BV), (BT, BV), (1, 0))
+        # [BT, BV]
+        b_v = tl.load(p_v, boundary_check=(0, 1))
+        b_do = tl.load(p_do, boundary_check=(0, 1))
+        b_dA += tl.dot(b_do, tl.trans(b_v))
+        # the intra-chunk gradients are added to the inter-chunk ones in place
+        b_dv = tl.load(p_dv, boundary_check=(0, 1)).to(tl.float32)
+        b_dv += tl.dot(tl.trans(b_A.to(b_do.dtype)), b_do)
+        tl.store(p_dv, b_dv.to(p_dv.dtype.element_ty), boundary_check=(0, 1))
+    # the levels below only read the strictly lower triangle of `b_dA` and fold the scale into the queries
+    # [BT,]
+    b_dAd = tl.sum(tl.where(o_i[:, None] == o_i[None, :], b_dA, 0.), 1) * scale
+
+    for i_k in range(tl.cdiv(K, BK)):
+        p_q = tl.make_block_ptr(q + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_k = tl.make_block_ptr(k + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_g = tl.make_block_ptr(g + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_dq = tl.make_block_ptr(dq + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        p_dk = tl.make_block_ptr(dk + i_bh * T*K, (T, K), (K, 1), (i_t * BT, i_k * BK), (BT, BK), (1, 0))
+        # [BT, BK]
+        b_q = tl.load(p_q, boundary_check=(0, 1)).to(tl.float32)
+        b_k = tl.load(p_k, boundary_check=(0, 1)).to(tl.float32)
+        b_g = tl.load(p_g, boundary_check=(0, 1)).to(tl.float32)
+        b_dq = b_dAd[:, None] * b_k
+        b_dk = b_dAd[:, None] * b_q
+        for i_s in tl.static_range(NS):
+            b_fq, b_fk, m_s = inner_chunk_decay(g, b_g, scale, i_t, i_bh, i_k, T, K, BT, BK, 2 ** i_s)
+            # [BT, BT]
+            b_dAs = tl.where(m_s, b_dA, 0.)
+            b_dq += b_fq * tl.dot(b_dAs, b_k * b_fk)
+            b_dk += b_fk * tl.dot(tl.trans(b_dAs), b_q * b_fq)
+        tl.store(p_dq, b_dq.to(p_dq.dtype.element_ty), boundary_check=(0, 1))
+        tl.store(p_dk, b_dk.to(p_dk.dtype.element_ty), boundary_check=(0, 1))
 
 
 class FusedChunkGLAFunction(torch.autograd.Function):
@@ -366,20 +526,22 @@ class FusedChunkGLAFunction(torch.autograd.Function):
     @staticmethod
     @input_guard
     @autocast_custom_fwd
-    def forward(ctx, q, k, v, g, scale, initial_state, output_final_state):
+    def forward(ctx, q, k, v, g, scale, initial_state, output_final_state, final_state_buf=None):
         ctx.g_dtype = g.dtype
         ctx.scale = scale
         B, H, T, K, V = *k.shape, v.shape[-1]
+        # the chunk size determines the layout of the cumulative decay and the intra-chunk scores,
+        # so it is kept fixed and only the tile sizes of the inter-chunk kernels are tuned
         BT = 16  # chunk_size
-        BK, BV = min(K, 64), min(V, 64)
-        NK, NV = triton.cdiv(K, BK), triton.cdiv(V, BV)
-        num_stages = 1
-        num_warps = 2
+        BK, BV = min(triton.next_power_of_2(K), 64), min(triton.next_power_of_2(V), 64)
+        NK = triton.cdiv(K, BK)
 
         g_org = g
         # cumulative decay should be in float32, otherwise the err will be accumulated and amplified.
-        g = chunk_local_cumsum(g_org, chunk_size=BT)
-        o = q.new_empty(NK, B, H, T, V)
+        # NOTE: it is stored in log2 space, i.e., scaled by 1/ln(2), and only consumed by the kernels below
+        g = torch.empty_like(g_org, dtype=torch.float)
+        # with multiple K blocks the partial outputs are accumulated atomically in float32
+        o = q.new_zeros(B, H, T, V, dtype=torch.float) if NK > 1 else q.new_empty(B, H, T, V)
         q_g = torch.empty_like(q)
         k_g = torch.empty_like(k)
 
@@ -387,6 +549,7 @@ class FusedChunkGLAFunction(torch.autograd.Function):
         prepare_qg_kg[grid](
             q,
             k,
+            g_org,
             g,
             q_g,
             k_g,
@@ -398,8 +561,18 @@ class FusedChunkGLAFunction(torch.autograd.Function):
             num_warps=1
         )
 
-        if output_final_state:
-            final_state = q.new_empty(B, H, K, V, dtype=torch.float, requires_grad=False)
+        if output_final_state and final_state_buf is not None:
+            # preallocated by the caller, e.g., a stateful layer reusing the same buffer across steps
+            assert final_state_buf.shape == (B, H, K, V) and final_state_buf.dtype == torch.float
+            # `input_guard` would otherwise have silently replaced a strided buffer by a contiguous copy
+            assert final_state_buf.is_contiguous(), "`final_state_buf` must be contiguous to be written in place"
+            # `initial_state` is saved for the backward pass, overwriting it would corrupt `dh0` and `dq`
+            assert final_state_buf is not initial_state, "`final_state_buf` must not alias `initial_state`"
+            # the buffer is an input modified in place and returned as the final state
+            ctx.mark_dirty(final_state_buf)
+            final_state = final_state_buf
+        elif output_final_state:
+            final_state = q.new_empty(B, H, K, V, dtype=torch.float)
         else:
             final_state = None
         # the bug still exists even for Triton 2.2 on H100 GPUs
@@ -416,52 +589,42 @@ class FusedChunkGLAFunction(torch.autograd.Function):
             )
             CHECK = True
 
-        grid = (NV, NK, B * H)
+        def grid(meta): return (triton.cdiv(V, meta['BV']), NK, B * H)
         fused_chunk_gla_fwd_kernel[grid](
             q_g, k_g, v, g, o, initial_state, final_state,
             T=T,
-            B=B,
-            H=H,
             K=K,
             V=V,
             BT=BT,
             BK=BK,
-            BV=BV,
+            NK=NK,
             USE_INITIAL_STATE=initial_state is not None,
             STORE_FINAL_STATE=output_final_state,
             CHECK=CHECK,
-            num_warps=num_warps,
-            num_stages=num_stages
+            ALLOW_TF32=ALLOW_TF32
         )
 
-        o = o.sum(0)
-
         # intra-chunk
-        chunk_size = 16
-        num_chunk = T // chunk_size
-        v2 = rearrange(v, 'b h (n c) d -> b h n c d', n=num_chunk)
-        BK = min(K, 64)
-        NK = triton.cdiv(K, BK)
-        A = q.new_empty(NK, B, H, triton.cdiv(T, BT), BT, BT)
-        grid = (NK, triton.cdiv(T, BT), B * H)
+        grid = (triton.cdiv(T, BT), B * H)
         fwd_inner_chunk[grid](
-            q, k, g, A,
+            q,
+            k,
+            v,
+            g,
+            o,
             scale,
-            B=B,
-            H=H,
             T=T,
             K=K,
+            V=V,
             BT=BT,
             BK=BK,
+            BV=BV,
             num_stages=3,
             num_warps=4
         )
-        A = A.sum(0)
-        o2 = A @ v2
-        o2 = rearrange(o2, 'b h n c d -> b h (n c) d')
-        # combine inner and inter
-        o.add_(o2)
-        ctx.save_for_backward(q, k, v, g_org, A, initial_state)
+
+        # the cumulative decay and the gated q/k are reused by the backward pass instead of being recomputed
+        ctx.save_for_backward(q, k, v, g, q_g, k_g, initial_state)
         ctx.CHECK = CHECK
         return o.to(v), final_state
 
@@ -469,40 +632,21 @@ class FusedChunkGLAFunction(torch.autograd.Function):
     @input_guard
     @autocast_custom_bwd
     def backward(ctx, do, dht=None):
-        q, k, v, g_org, A, initial_state = ctx.saved_tensors
+        q, k, v, g, q_g, k_g, initial_state = ctx.saved_tensors
         B, H, T, K, V = *k.shape, v.shape[-1]
         scale = ctx.scale
 
-        # recomputation
         # inter-chunk
         BT = 16  # chunk_size
-        g = chunk_local_cumsum(g_org, chunk_size=BT)
-        BK, BV = min(K, 64), min(V, 64)
-        NK, NV = triton.cdiv(K, BK), triton.cdiv(V, BV)
-        q_g = torch.empty_like(q)
-        k_g = torch.empty_like(k)
-        grid = (NK, triton.cdiv(T, BT), B * H)
-        prepare_qg_kg[grid](
-            q,
-            k,
-            g,
-            q_g,
-            k_g,
-            scale,
-            T=T,
-            K=K,
-            BT=BT,
-            BK=BK,
-            num_warps=1
-        )
-
         BK, BV = min(triton.next_power_of_2(K), 64), min(triton.next_power_of_2(V), 64)
         NK, NV = triton.cdiv(K, BK), triton.cdiv(V, BV)
-        num_stages = 1
-        num_warps = 2
-        dq = q.new_empty(NV, B, H, T, K)
-        dk = q.new_empty(NV, B, H, T, K)
-        dv = q.new_empty(NK, B, H, T, V)
+        # partial gradients of multiple K/V blocks are accumulated atomically in float32
+        dq = q.new_zeros(B, H, T, K, dtype=torch.float) if NV > 1 else q.new_empty(B, H, T, K)
+        dk = q.new_zeros(B, H, T, K, dtype=torch.float) if NV > 1 else q.new_empty(B, H, T, K)
+        dv = q.new_zeros(B, H, T, V, dtype=torch.float) if NK > 1 else q.new_empty(B, H, T, V)
+        dh0 = torch.empty_like(initial_state, dtype=torch.float) if initial_state is not None else None
+        # per V block contributions of the final state gradient to the decay
+        dgt = q.new_empty(B, H, NV, K, dtype=torch.float) if dht is not None else None
 
         grid = (NV, NK, B * H)
 
@@ -516,53 +660,50 @@ class FusedChunkGLAFunction(torch.autograd.Function):
             dk,
             dv,
             initial_state,
+            dht,
+            dh0,
+            dgt,
             scale,
             T=T,
-            B=B,
-            H=H,
             K=K,
             V=V,
             BT=BT,
             BK=BK,
             BV=BV,
+            NK=NK,
+            NV=NV,
             USE_INITIAL_STATE=initial_state is not None,
+            USE_FINAL_STATE_GRADIENT=dht is not None,
+            STORE_INITIAL_STATE_GRADIENT=initial_state is not None,
             CHECK=ctx.CHECK,
-            num_warps=num_warps,
-            num_stages=num_stages,
+            ALLOW_TF32=ALLOW_TF32
         )
-        dq = dq.sum(0)
-        dk = dk.sum(0)
-        dv = dv.sum(0)
 
         # intra chunk
-        NT = T // BT
-        v2 = rearrange(v, 'b h (n c) d -> b h n c d', n=NT)
-        do2 = rearrange(do, 'b h (n c) d -> b h n c d', n=NT)
-        dA2 = (do2 @ v2.transpose(-2, -1)) * scale
-        dv2 = A.transpose(-1, -2) @ do2
-        dv2 = rearrange(dv2, 'b h n c d -> b h (n c) d', n=NT)
-
-        BK = min(triton.next_power_of_2(K), 16)
-        NK = triton.cdiv(K, BK)
         dk2 = torch.empty_like(k)
         dq2 = torch.empty_like(q)
 
-        grid = (NK, NT, B * H)
+        grid = (triton.cdiv(T, BT), B * H)
         bwd_inner_chunk[grid](
-            q, k, g,
-            dA2,
+            q,
+            k,
+            v,
+            g,
+            do,
             dq2,
             dk2,
+            dv,
+            scale,
             T=T,
             K=K,
+            V=V,
             BT=BT,
             BK=BK,
-            num_warps=1,
+            BV=BV,
+            num_warps=4,
             num_stages=3
         )
 
-        BK = min(triton.next_power_of_2(K), 32)
-        NK = triton.cdiv(K, BK)
         dg = torch.empty_like(g, dtype=torch.float32)
         grid = (NK, triton.cdiv(T, BT), B * H)
         bwd_decay_global_cumsum[grid](
@@ -581,19 +722,42 @@ class FusedChunkGLAFunction(torch.autograd.Function):
             num_warps=1,
             num_stages=1
         )
-        dg = rearrange(dg, 'b h (n c) d -> b h n c d', c=BT)
-
-        def rev_cumsum_exclusive(x):
-            cumsum_x = x.cumsum(-2)
-            rev_cumsum_x = cumsum_x[..., -1, None, :] - cumsum_x
-            return rev_cumsum_x
+        grid = (NK, B * H)
+        bwd_decay_rev_cumsum_add[grid](
+            dg,
+            dgt.sum(2) if dht is not None else None,
+            T=T,
+            K=K,
+            BT=BT,
+            BK=BK,
+            USE_FINAL_STATE_GRADIENT=dht is not None,
+            num_warps=1
+        )
 
-        rev_cumsum_dg = rev_cumsum_exclusive(dg[..., 0, :])
-        dg.add_(rev_cumsum_dg.unsqueeze(-2))
-        dv.add_(dv2)
-        dg = rearrange(dg, 'b h n c d -> b h (n c) d')
+        if dh0 is not None:
+            dh0 = dh0.to(initial_state)
+        return dq.to(q), dk.to(k), dv.to(v), dg.to(ctx.g_dtype), None, dh0, None, None
 
-        return dq.to(q), dk.to(k), dv.to(v), dg.to(ctx.g_dtype), None, None, None
+    @staticmethod
+    def warmup(
+        K: int,
+        V: int,
+        dtype: torch.dtype = torch.bfloat16,
+        device: Union[str, torch.device] = device,
+        use_initial_state: bool = False,
+        output_final_state: bool = False
+    ):
+        r"""
+        Compiles and autotunes all forward and backward kernels for the given head dims ahead of the first real call.
+        As the kernels specialize on neither the batch size, the number of heads nor the sequence length,
+        a single chunk is enough to populate the caches for all inputs sharing `K`, `V`, `dtype` and the state flags.
+        """
+        q, k = (torch.randn(1, 1, 16, K, dtype=dtype, device=device, requires_grad=True) for _ in range(2))
+        v = torch.randn(1, 1, 16, V, dtype=dtype, device=device, requires_grad=True)
+        g = F.logsigmoid(torch.randn(1, 1, 16, K, device=device)).to(dtype).requires_grad_()
+        h0 = torch.zeros(1, 1, K, V, dtype=torch.float, device=device) if use_initial_state else None
+        o, _ = FusedChunkGLAFunction.apply(q, k, v, g, K ** -0.5, h0, output_final_state)
+        o.sum().backward()
 
 
 def ceildiv(a, b):
@@ -617,13 +781,45 @@ def fused_chunk_gla(
     initial_state: torch.Tensor = None,
     output_final_state: bool = False,
     head_first: bool = False,
+    final_state_buf: Optional[torch.Tensor] = None
 ) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""
+    Args:
+        q (torch.Tensor):
+            queries of shape `[B, T, H, K]` if `head_first=False` else `[B, H, T, K]`.
+        k (torch.Tensor):
+            keys of shape `[B, T, H, K]` if `head_first=False` else `[B, H, T, K]`.
+        v (torch.Tensor):
+            values of shape `[B, T, H, V]` if `head_first=False` else `[B, H, T, V]`.
+        g (torch.Tensor):
+            Forget gates of shape `[B, T, H, K]` if `head_first=False` else `[B, H, T, K]`.
+        scale (Optional[float]):
+            Scale factor for the attention scores.
+            If not provided, it will default to `1 / sqrt(K)`. Default: `-1`.
+        initial_state (Optional[torch.Tensor]):
+            Initial state of shape `[B, H, K, V]`. Default: `None`.
+        output_final_state (Optional[bool]):
+            Whether to output the final state of shape `[B, H, K, V]`. Default: `False`.
+        head_first (Optional[bool]):
+            Whether the inputs are in the head-first format. Default: `False`.
+            This argument has been deprecated.
+        final_state_buf (Optional[torch.Tensor]):
+            Preallocated contiguous float32 buffer of shape `[B, H, K, V]` for the final state.
+            If given together with `output_final_state=True`, it is overwritten in place and returned as the final state.
+            It must not be `initial_state` itself, which is still needed by the backward pass.
+            Default: `None`.
+
+    Returns:
+        o (torch.Tensor):
+            Outputs of shape `[B, T, H, V]` if `head_first=False` else `[B, H, T, V]`.
+        final_state (torch.Tensor):
+            Final state of shape `[B, H, K, V]` if `output_final_state=True` else `None`.
+    """
     if head_first:
         warnings.warn(
             "head_first is deprecated and will be removed in a future version. "
             "Please use head_first=False for now instead."
         )
-        q, k, v, g = map(lambda x: rearrange(x, 'b h t ... -> b t h ...'), (q, k, v, g))
     if not head_first and q.shape[1] < q.shape[2]:
         warnings.warn(
             f"Input tensor shape suggests potential format mismatch: seq_len ({q.shape[1]}) < num_heads ({q.shape[2]}). "
@@ -633,10 +829,13 @@ def fused_chunk_gla(
         )
     if scale == -1:
         scale = q.shape[-1] ** -0.5
+    # the kernels work on the head-first layout [B, H, T, ...]
+    if not head_first:
+        q, k, v, g = map(lambda x: x.transpose(1, 2), (q, k, v, g))
     seq_len = q.shape[-2]
     q, k, v, g = map(lambda x: pad(x), [q, k, v, g])
-    o, final_state = FusedChunkGLAFunction.apply(q, k, v, g, scale, initial_state, output_final_state)
-    o = o[..., :seq_len, :].contiguous()
-    if head_first:
-        o = rearrange(o, 'b t h ... -> b h t ...')
-    return o, final_state
+    o, final_state = FusedChunkGLAFunction.apply(q, k, v, g, scale, initial_state, output_final_state, final_state_buf)
+    o = o[..., :seq_len, :]
+    if not head_first:
+        o = o.transpose(1, 2)
+    return o.contiguous(), final_state
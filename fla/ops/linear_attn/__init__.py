@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from .chunk import chunk_linear_attn
+from .featmap import featmap_norm
 from .fused_chunk import fused_chunk_linear_attn
 from .fused_recurrent import fused_recurrent_linear_attn
 
 __all__ = [
     'chunk_linear_attn',
+    'featmap_norm',
     'fused_chunk_linear_attn',
     'fused_recurrent_linear_attn'
 ]
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023-2025, Songlin Yang, Yu Zhang
+
+import torch
+import triton
+import triton.language as tl
+
+from fla.ops.utils.op import exp
+from fla.utils import input_guard
+
+BT_LIST = [8, 16, 32, 64, 128]
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({'BT': BT}, num_warps=num_warps)
+        for num_warps in [1, 2, 4, 8, 16]
+        for BT in BT_LIST
+    ],
+    key=['D', 'KIND']
+)
+@triton.jit
+def featmap_norm_fwd_kernel(
+    x,
+    y,
+    T,
+    eps,
+    D: tl.constexpr,
+    BD: tl.constexpr,
+    BT: tl.constexpr,
+    KIND: tl.constexpr,
+):
+    i_t = tl.program_id(0)
+    p_x = tl.make_block_ptr(x, (T, D), (D, 1), (i_t * BT, 0), (BT, BD), (1, 0))
+    p_y = tl.make_block_ptr(y, (T, D), (D, 1), (i_t * BT, 0), (BT, BD), (1, 0))
+
+    b_x = tl.load(p_x, boundary_check=(0, 1)).to(tl.float32)
+    if KIND == 'elu':
+        b_f = tl.where(b_x > 0, b_x + 1, exp(b_x))
+    elif KIND == 'relu':
+        b_f = tl.maximum(b_x, 0.)
+    else:
+        b_f = b_x
+    # padded columns must not contribute to the normalizer, e.g., `elu(0) + 1 = 1`
+    b_f = tl.where((tl.arange(0, BD) < D)[None, :], b_f, 0.)
+    b_y = b_f / (tl.sum(b_f, 1) + eps)[:, None]
+    tl.store(p_y, b_y.to(p_y.dtype.element_ty), boundary_check=(0, 1))
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({'BT': BT}, num_warps=num_warps)
+        for num_warps in [1, 2, 4, 8, 16]
+        for BT in BT_LIST
+    ],
+    key=['D', 'KIND']
+)
+@triton.jit
+def featmap_norm_bwd_kernel(
+    x,
+    dy,
+    dx,
+    T,
+    eps,
+    D: tl.constexpr,
+    BD: tl.constexpr,
+    BT: tl.constexpr,
+    KIND: tl.constexpr,
+):
+    i_t = tl.program_id(0)
+    p_x = tl.make_block_ptr(x, (T, D), (D, 1), (i_t * BT, 0), (BT, BD), (1, 0))
+    p_dy = tl.make_block_ptr(dy, (T, D), (D, 1), (i_t * BT, 0), (BT, BD), (1, 0))
+    p_dx = tl.make_block_ptr(dx, (T, D), (D, 1), (i_t * BT, 0), (BT, BD), (1, 0))
+
+    b_x = tl.load(p_x, boundary_check=(0, 1)).to(tl.float32)
+    # recompute the feature map and its derivative
+    if KIND == 'elu':
+        b_f = tl.where(b_x > 0, b_x + 1, exp(b_x))
+        b_df = tl.where(b_x > 0, 1., b_f)
+    elif KIND == 'relu':
+        b_f = tl.maximum(b_x, 0.)
+        b_df = tl.where(b_x > 0, 1., 0.)
+    else:
+        b_f = b_x
+        b_df = tl.full([BT, BD], 1., dtype=tl.float32)
+    b_f = tl.where((tl.arange(0, BD) < D)[None, :], b_f, 0.)
+    b_rz = 1 / (tl.sum(b_f, 1) + eps)
+    b_y = b_f * b_rz[:, None]
+
+    b_dy = tl.load(p_dy, boundary_check=(0, 1)).to(tl.float32)
+    b_dx = (b_dy - tl.sum(b_dy * b_y, 1)[:, None]) * b_rz[:, None] * b_df
+    tl.store(p_dx, b_dx.to(p_dx.dtype.element_ty), boundary_check=(0, 1))
+
+
+def featmap_norm_fwd(
+    x: torch.Tensor,
+    kind: str,
+    eps: float = 1e-4
+) -> torch.Tensor:
+    x_shape_og = x.shape
+    x = x.view(-1, x.shape[-1])
+    y = torch.empty_like(x)
+    T, D = x.shape
+    BD = triton.next_power_of_2(D)
+
+    def grid(meta): return (triton.cdiv(T, meta['BT']),)
+    featmap_norm_fwd_kernel[grid](
+        x=x,
+        y=y,
+        T=T,
+        eps=eps,
+        D=D,
+        BD=BD,
+        KIND=kind,
+    )
+    return y.view(x_shape_og)
+
+
+def featmap_norm_bwd(
+    x: torch.Tensor,
+    dy: torch.Tensor,
+    kind: str,
+    eps: float = 1e-4
+) -> torch.Tensor:
+    x_shape_og = x.shape
+    x = x.view(-1, x.shape[-1])
+    dy = dy.view(-1, dy.shape[-1])
+    dx = torch.empty_like(x)
+    T, D = x.shape
+    BD = triton.next_power_of_2(D)
+
+    def grid(meta): return (triton.cdiv(T, meta['BT']),)
+    featmap_norm_bwd_kernel[grid](
+        x=x,
+        dy=dy,
+        dx=dx,
+        T=T,
+        eps=eps,
+        D=D,
+        BD=BD,
+        KIND=kind,
+    )
+    return dx.view(x_shape_og)
+
+
+class FeatmapNormFunction(torch.autograd.Function):
+
+    @staticmethod
+    @input_guard
+    def forward(ctx, x, kind='elu', eps=1e-4):
+        y = featmap_norm_fwd(x, kind, eps)
+        ctx.kind = kind
+        ctx.eps = eps
+        ctx.save_for_backward(x)
+        return y
+
+    @staticmethod
+    @input_guard
+    def backward(ctx, dy):
+        x, = ctx.saved_tensors
+        dx = featmap_norm_bwd(x, dy, ctx.kind, ctx.eps)
+        return dx, None, None
+
+
+def featmap_norm(
+    x: torch.Tensor,
+    kind: str = 'elu',
+    eps: float = 1e-4
+) -> torch.Tensor:
+    r"""
+    Applies a parameter-free feature map to the last dimension of `x` and normalizes the result by its sum,
+    i.e., `f(x) / (f(x).sum(-1, True) + eps)`, in a single pass.
+
+    Args:
+        x (torch.Tensor):
+            Inputs of shape `[..., D]`.
+        kind (str):
+            The feature map to apply, one of `'elu'` (`elu(x) + 1`), `'relu'` or `'identity'`. Default: `'elu'`.
+        eps (float):
+            Small constant added to the normalizer. Default: `1e-4`.
+
+    Returns:
+        Normalized features of the same shape and dtype as `x`.
+    """
+    assert kind in ['elu', 'relu', 'identity'], f"Not supported feature map `{kind}`."
+    return FeatmapNormFunction.apply(x, kind, eps)
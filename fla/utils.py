@@ -9,7 +9,7 @@ import sys
 import warnings
 from enum import Enum
 from functools import lru_cache
-from typing import TYPE_CHECKING, Any, Callable, Dict, Literal, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Literal, Optional, Tuple
 
 import torch
 import triton
@@ -93,10 +93,12 @@ def tensor_cache(
     fn: Callable[..., torch.Tensor]
 ) -> Callable[..., torch.Tensor]:
     """
-    A decorator that caches the most recent result of a function with tensor inputs.
+    A decorator that caches the most recent results of a function with tensor inputs.
 
-    This decorator will store the output of the decorated function for the most recent set of input tensors.
+    This decorator will store the outputs of the decorated function for the most recent sets of input tensors,
+    keeping up to `cache_size` entries evicted in LRU order.
     If the function is called again with the same input tensors, it will return the cached result.
+    Keeping several entries avoids thrashing when e.g. chunk indices of different chunk sizes are requested alternately.
 
 
     Args:
@@ -105,24 +107,24 @@ def tensor_cache(
 
     Returns:
         Callable[..., torch.Tensor]:
-            A wrapped version of the input function with single-entry caching.
+            A wrapped version of the input function with LRU caching.
     """
-    last_args: Optional[Tuple] = None
-    last_kwargs: Optional[Dict] = None
-    last_result: Any = None
+    cache_entries: List[Tuple[Tuple, Dict, Any]] = []
+    cache_size = 8
 
     @functools.wraps(fn)
     def wrapper(*args: Any, **kwargs: Any) -> Any:
-        nonlocal last_args, last_kwargs, last_result
-
-        if last_args is not None and last_kwargs is not None:
+        for i, (last_args, last_kwargs, last_result) in enumerate(cache_entries):
             if len(args) == len(last_args) and len(kwargs) == len(last_kwargs):
                 if all(a is b for a, b in zip(args, last_args)) and \
                         all(k in last_kwargs and v is last_kwargs[k] for k, v in kwargs.items()):
+                    cache_entries.append(cache_entries.pop(i))
                     return last_result
 
         result = fn(*args, **kwargs)
-        last_args, last_kwargs, last_result = args, kwargs, result
+        if len(cache_entries) >= cache_size:
+            cache_entries.pop(0)
+        cache_entries.append((args, kwargs, result))
         return result
 
     return wrapper
@@ -7,7 +7,7 @@ import pytest
 import torch
 import torch.nn.functional as F
 
-from fla.ops.gla import chunk_gla, fused_recurrent_gla
+from fla.ops.gla import chunk_gla, fused_chunk_gla, fused_recurrent_gla
 from fla.ops.gla.naive import naive_recurrent_gla
 from fla.utils import assert_close, device, device_platform
 
@@ -89,6 +89,86 @@ def test_fused_recurrent(
     assert_close('dh0', ref_dh0, tri_dh0, 0.005)
 
 
+@pytest.mark.parametrize(
+    ('B', 'T', 'H', 'D', 'gate_logit_normalizer', 'use_initial_state', 'dtype'),
+    [
+        pytest.param(*test, id="B{}-T{}-H{}-D{}-gate_logit_normalizer{}-use_initial_state{}-{}".format(*test))
+        for test in [
+            (1, 63, 1, 128, 1, False, torch.float16),
+            (2, 500, 4, 128, 1, True, torch.float16),
+            # strong decay, i.e., well beyond the fp16 range if the decay within a chunk is not bounded by 1
+            (2, 500, 4, 128, 0.25, True, torch.float16),
+            (2, 1000, 4, 256, 0.1, True, torch.bfloat16),
+            (2, 1024, 4, 128, 10, False, torch.bfloat16),
+        ]
+    ]
+)
+@pytest.mark.skipif(
+    device_platform == 'intel',
+    reason='Intel Triton Failure'
+)
+def test_fused_chunk(
+    B: int,
+    T: int,
+    H: int,
+    D: int,
+    gate_logit_normalizer: float,
+    use_initial_state: bool,
+    dtype: torch.dtype
+):
+    torch.manual_seed(42)
+    os.environ['TRITON_F32_DEFAULT'] = 'ieee'
+    # D >= 128 to split K and V into multiple blocks, whose partial results are accumulated atomically
+    q = torch.rand((B, T, H, D), dtype=dtype, device=device).requires_grad_()
+    k = torch.rand((B, T, H, D), dtype=dtype, device=device).requires_grad_()
+    v = torch.rand((B, T, H, D), dtype=dtype, device=device).requires_grad_()
+    g = (F.logsigmoid(torch.rand((B, T, H, D), dtype=dtype, device=device)) / gate_logit_normalizer).requires_grad_()
+    h0 = torch.rand((B, H, D, D), device=device).requires_grad_() if use_initial_state else None
+    do = torch.randn_like(v)
+    dht = torch.randn((B, H, D, D), dtype=dtype, device=device)
+
+    ref, ref_ht = fused_recurrent_gla(
+        q=q,
+        k=k,
+        v=v,
+        gk=g,
+        initial_state=h0,
+        output_final_state=True
+    )
+    ((ref * do).sum() + (ref_ht * dht).sum()).backward()
+    ref_dq, q.grad = q.grad.clone(), None
+    ref_dk, k.grad = k.grad.clone(), None
+    ref_dv, v.grad = v.grad.clone(), None
+    ref_dg, g.grad = g.grad.clone(), None
+    if use_initial_state:
+        ref_dh0, h0.grad = h0.grad.clone(), None
+
+    tri, tri_ht = fused_chunk_gla(
+        q=q,
+        k=k,
+        v=v,
+        g=g,
+        initial_state=h0,
+        output_final_state=True
+    )
+    ((tri * do).sum() + (tri_ht * dht).sum()).backward()
+    tri_dq, q.grad = q.grad.clone(), None
+    tri_dk, k.grad = k.grad.clone(), None
+    tri_dv, v.grad = v.grad.clone(), None
+    tri_dg, g.grad = g.grad.clone(), None
+    if use_initial_state:
+        tri_dh0, h0.grad = h0.grad.clone(), None
+
+    assert_close('o', ref, tri, 0.005)
+    assert_close('ht', ref_ht, tri_ht, 0.005)
+    assert_close('dq', ref_dq, tri_dq, 0.008)
+    assert_close('dk', ref_dk, tri_dk, 0.008)
+    assert_close('dv', ref_dv, tri_dv, 0.008)
+    assert_close('dg', ref_dg, tri_dg, 0.008)
+    if use_initial_state:
+        assert_close('dh0', ref_dh0, tri_dh0, 0.008)
+
+
 @pytest.mark.parametrize(
     ('H', 'D', 'cu_seqlens', 'dtype'),
     [
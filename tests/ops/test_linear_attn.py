@@ -4,8 +4,10 @@ from typing import Optional
 
 import pytest
 import torch
+import torch.nn.functional as F
 
-from fla.ops.linear_attn import chunk_linear_attn, fused_chunk_linear_attn, fused_recurrent_linear_attn
+from fla.layers import LinearAttention
+from fla.ops.linear_attn import chunk_linear_attn, featmap_norm, fused_chunk_linear_attn, fused_recurrent_linear_attn
 from fla.ops.linear_attn.naive import naive_recurrent_linear_attn
 from fla.utils import assert_close, device
 
@@ -189,3 +191,87 @@ def test_fused_chunk(
     assert_close('dk', ref_dk, tri_dk, 0.001)
     assert_close('dv', ref_dv, tri_dv, 0.001)
     assert_close('dh0', ref_dh0, tri_dh0, 0.001)
+
+
+@pytest.mark.parametrize(
+    ('B', 'T', 'H', 'D', 'kind', 'dtype'),
+    [
+        pytest.param(*test, id="B{}-T{}-H{}-D{}-{}-{}".format(*test))
+        for test in [
+            (1, 63, 1, 64, 'elu', torch.float),
+            (2, 500, 3, 60, 'elu', torch.float),
+            (2, 500, 3, 60, 'relu', torch.float),
+            (3, 1024, 4, 128, 'elu', torch.bfloat16),
+            (3, 1024, 4, 128, 'relu', torch.bfloat16),
+            (2, 500, 3, 60, 'identity', torch.float),
+            (3, 1024, 4, 128, 'identity', torch.bfloat16),
+        ]
+    ]
+)
+def test_featmap_norm(
+    B: int,
+    T: int,
+    H: int,
+    D: int,
+    kind: str,
+    dtype: torch.dtype
+):
+    torch.manual_seed(42)
+    x = torch.randn((B, T, H, D), dtype=dtype, device=device)
+    # keep the denominator away from zero for the identity map
+    x = (x.abs() if kind == 'identity' else x).requires_grad_()
+    do = torch.randn_like(x)
+
+    ref = {'elu': lambda x: F.elu(x) + 1, 'relu': F.relu, 'identity': lambda x: x}[kind](x.float())
+    ref = (ref / (ref.sum(-1, True) + 1e-4)).to(dtype)
+    ref_dx = torch.autograd.grad((ref * do).sum(), x)[0]
+
+    tri = featmap_norm(x, kind)
+    tri_dx = torch.autograd.grad((tri * do).sum(), x)[0]
+
+    assert_close('y', ref, tri, 0.005)
+    assert_close('dx', ref_dx, tri_dx, 0.005)
+
+
+@pytest.mark.parametrize(
+    ('B', 'T', 'H', 'D', 'feature_map', 'dtype'),
+    [
+        pytest.param(*test, id="B{}-T{}-H{}-D{}-{}-{}".format(*test))
+        for test in [
+            (2, 500, 4, 64, 'elu', torch.float),
+            (2, 500, 4, 64, 'relu', torch.float),
+            (2, 1024, 4, 128, 'elu', torch.bfloat16),
+        ]
+    ]
+)
+def test_layer_featmap_norm(
+    B: int,
+    T: int,
+    H: int,
+    D: int,
+    feature_map: str,
+    dtype: torch.dtype
+):
+    torch.manual_seed(42)
+    layer = LinearAttention(
+        mode='chunk',
+        hidden_size=H * D,
+        num_heads=H,
+        feature_map=feature_map,
+        norm_q=True,
+        norm_k=True
+    ).to(device=device, dtype=dtype)
+    assert layer.fuse_feature_map_norm
+    x = torch.randn((B, T, H * D), dtype=dtype, device=device).requires_grad_()
+    do = torch.randn_like(x)
+
+    tri = layer(x)
+    tri_dx = torch.autograd.grad((tri * do).sum(), x)[0]
+
+    # the unfused path applies `feature_map_q/k` and divides by `sum + 1e-4`
+    layer.fuse_feature_map_norm = False
+    ref = layer(x)
+    ref_dx = torch.autograd.grad((ref * do).sum(), x)[0]
+
+    assert_close('o', ref, tri, 0.005)
+    assert_close('dx', ref_dx, tri_dx, 0.005)
@@ -1,66 +1,109 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import os
 from typing import List
 
 import pytest
 import torch
-from einops import rearrange
 
 from fla.ops.path_attn.parallel import parallel_path_attention
 from fla.utils import assert_close, device, is_intel_alchemist
 
 
-def naive_path_attn(q, k, v, w, beta, g, scale, BT=64):
+@functools.lru_cache(maxsize=32)
+def get_eye(BT: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    return torch.eye(BT, dtype=dtype, device=device)
+
+
+@functools.lru_cache(maxsize=32)
+def get_triu_indices(BT: int, device: torch.device) -> torch.Tensor:
+    # the cached tensors are shared across calls and must never be modified in place
+    return torch.triu_indices(BT, BT, offset=1, device=device)
+
+
+def naive_path_attn(q, k, v, w, beta, g, scale, BT=64, g_cumsum=None):
     original_dtype = q.dtype
     HQ = q.shape[2]
     H = k.shape[2]
-    q, k, v, w, beta, g = map(lambda x: x.to(torch.float32).transpose(1, 2), [q, k, v, w, beta, g])
-    g_cumsum = g.cumsum(-1)
-    q = q.unsqueeze(2).expand(-1, -1, HQ//HQ, -1, -1).flatten(1, 2)
-    k = k.unsqueeze(2).expand(-1, -1, HQ//H, -1, -1).flatten(1, 2)
-    v = v.unsqueeze(2).expand(-1, -1, HQ//H, -1, -1).flatten(1, 2)
-    w = w.unsqueeze(2).expand(-1, -1, HQ//H, -1, -1).flatten(1, 2)
-    beta = beta.unsqueeze(2).expand(-1, -1, HQ//H, -1).flatten(1, 2)
-
-    b, h, l, d_k = q.shape
+    q, k, v, w, beta = map(lambda x: x.to(torch.float32).transpose(1, 2), [q, k, v, w, beta])
+    # beta is only ever used through `w_beta`, which is formed right away and padded in its place
+    w_beta = w * beta[..., None]
+    # `g_cumsum` may be precomputed by the caller, e.g., once over all packed sequences
+    if g_cumsum is None:
+        g_cumsum = torch.cumsum(g, 1, dtype=torch.float32)
+    g_cumsum = g_cumsum.to(torch.float32).transpose(1, 2)
+    # the scores are linear in q, so the scale is folded into q and the gate bias once
+    # instead of being applied to every score block
+    q, g_cumsum = q * scale, g_cumsum * scale
+
+    b, _, l, d_k = q.shape
+    G = HQ // H
     if l % BT != 0:
         padding_size = BT - l % BT
-        q, k, w = map(lambda x: torch.nn.functional.pad(x, (0, 0, 0, padding_size)), [q, k, w])
-        beta = torch.nn.functional.pad(beta, (0, padding_size))
+        q, k, v, w, w_beta = map(lambda x: torch.nn.functional.pad(x, (0, 0, 0, padding_size)), [q, k, v, w, w_beta])
+        g_cumsum = torch.nn.functional.pad(g_cumsum, (0, padding_size))
     seq_len = q.shape[2]
-    w_beta = w * beta[..., None]
-    q, k, w, w_beta = map(lambda x: rearrange(x, 'b h (n c) d -> b h n c d', c=BT), [q, k, w, w_beta])
-    mask = torch.triu(torch.ones(BT, BT, dtype=torch.bool, device=q.device), diagonal=0)
-    T = -(w_beta @ w.transpose(-1, -2)).masked_fill(mask, 0)
-    for i in range(1, BT):
-        T[..., i, :i] = T[..., i, :i].clone() + (T[..., i, :, None].clone() * T[..., :, :i].clone()).sum(-2)
-    T = T + torch.eye(BT, dtype=q.dtype, device=q.device)
-    Twbk = T @ (w_beta @ k.transpose(-1, -2)).masked_fill(mask, 0)
+    NT = seq_len // BT
+    # the G query heads of each group are kept in a separate dim rather than replicating the key/value heads,
+    # so everything below that only involves k, v, w and beta is computed once per key/value head
+    k, v, w, w_beta = map(lambda x: x.reshape(b, H, 1, NT, BT, -1), [k, v, w, w_beta])
+    q, g_cumsum = q.reshape(b, H, G, NT, BT, d_k), g_cumsum.reshape(b, H, G, NT, BT)
+    # T = (I + tril(w_beta w^T, -1))^{-1}, i.e., the forward substitution done by a single batched triangular solve,
+    # only the strictly lower triangle of the input is read as the diagonal is taken to be one
+    T = torch.linalg.solve_triangular(
+        w_beta @ w.transpose(-1, -2),
+        get_eye(BT, q.dtype, q.device),
+        upper=False,
+        unitriangular=True
+    )
+    Twbk = T @ (w_beta @ k.transpose(-1, -2)).tril_(-1)
     qw = (q @ w.transpose(-1, -2)).tril()
     Twb = T @ w_beta
     A_local = (q @ k.transpose(-1, -2)).tril() - qw @ Twbk
     q = q - qw @ Twb
     k = k - Twbk.transpose(-1, -2) @ w
-    H = w.transpose(-1, -2) @ Twb
-    A = torch.zeros(b, h, seq_len, seq_len, device=q.device)
-    q, k, w, w_beta = map(lambda x: rearrange(x, 'b h n c d -> b h (n c) d'), [q, k, w, w_beta])
-    for i in range(0, seq_len, BT):
-        q_i = q[:, :, i:i+BT].clone()
-        for j in range(i - BT, -BT, -BT):
-            k_j = k[:, :, j:j+BT]
-            A_ij = q_i @ k_j.transpose(-1, -2)
-            A[:, :, i:i+BT, j:j+BT] = A_ij
-            q_i = q_i - q_i @ H[:, :, j // BT]
-    for i in range(0, seq_len//BT):
-        A[:, :, i*BT:i*BT+BT, i*BT:i*BT+BT] = A_local[:, :, i]
-    A = A.masked_fill_(~torch.tril(torch.ones(seq_len, seq_len, device=q.device, dtype=torch.bool)), float("-inf"))
-    A = A[:, :, :l, :l]
-    A = A + g_cumsum[..., None] - g_cumsum[..., None, :]
-    ref_o = (A * scale).softmax(-1).to(v) @ v
+    P = w.transpose(-1, -2) @ Twb
+
+    # the scores are kept as block diagonals, i.e., blocks (i, i - d) for d = 0, ..., NT-1,
+    # so that the dense [seq_len, seq_len] matrix `A` is never materialized
+    S = []
+    # before the d-th step, `q_i` holds q_i (I - P_{i-1}) ... (I - P_{i-d+1}) for all i >= d
+    q_i = q
+    for d in range(NT):
+        if d == 0:
+            # only the strictly upper triangle is written, no mask is materialized or traversed
+            i_r, i_c = get_triu_indices(BT, q.device)
+            s = A_local
+            s[..., i_r, i_c] = float("-inf")
+        else:
+            q_i = q_i[:, :, :, 1:]
+            s = q_i @ k[:, :, :, :NT-d].transpose(-1, -2)
+            q_i = q_i - q_i @ P[:, :, :, :NT-d]
+        # the relative gate bias of the block is formed in a single op and added in place
+        s.add_(g_cumsum[:, :, :, d:, :, None] - g_cumsum[:, :, :, :NT-d, None, :])
+        S.append(s)
+
+    # blockwise softmax, the row maxima are constants as softmax is shift-invariant
+    with torch.no_grad():
+        m = q.new_full((b, H, G, NT, BT), float("-inf"))
+        for d, s in enumerate(S):
+            m = torch.maximum(m, torch.nn.functional.pad(s.amax(-1), (0, 0, d, 0), value=float("-inf")))
+    z = q.new_zeros(b, H, G, NT, BT)
+    o = q.new_zeros(b, H, G, NT, BT, v.shape[-1])
+    for d, s in enumerate(S):
+        p = torch.exp(s - m[:, :, :, d:, :, None])
+        z = z + torch.nn.functional.pad(p.sum(-1), (0, 0, d, 0))
+        o = o + torch.nn.functional.pad(p @ v[:, :, :, :NT-d], (0, 0, 0, 0, d, 0))
+    ref_o = (o / z[..., None]).reshape(b, HQ, seq_len, -1)[:, :, :l]
     return ref_o.to(original_dtype).transpose(1, 2)
 
 
+# compiling the reference fuses its many small elementwise ops, opt-in as compilation itself takes a while
+if os.getenv("FLA_TEST_COMPILE") == "1":
+    naive_path_attn = torch.compile(naive_path_attn, mode="reduce-overhead", dynamic=False)
+
+
 @pytest.mark.parametrize(
     ('B', 'T', 'H', 'HQ', 'D', 'use_forget_gate', 'dtype'),
     [
@@ -105,23 +148,23 @@ def test_parallel(
     scale = D ** -0.5
     ref = naive_path_attn(q, k, v, w, beta, torch.zeros(B, T, HQ, device=device, dtype=torch.float) if g is None else g, scale)
     ref.backward(do)
-    ref_dq, q.grad = q.grad.clone(), None
-    ref_dk, k.grad = k.grad.clone(), None
-    ref_dv, v.grad = v.grad.clone(), None
+    ref_dq, q.grad = q.grad, None
+    ref_dk, k.grad = k.grad, None
+    ref_dv, v.grad = v.grad, None
     if use_forget_gate:
-        ref_dg, g.grad = g.grad.clone(), None
-    ref_dw, w.grad = w.grad.clone(), None
-    ref_db, beta.grad = beta.grad.clone(), None
+        ref_dg, g.grad = g.grad, None
+    ref_dw, w.grad = w.grad, None
+    ref_db, beta.grad = beta.grad, None
 
     tri, _ = parallel_path_attention(q=q, k=k, v=v, w=w, beta=beta, g=g, scale=scale)
     tri.backward(do)
-    tri_dq, q.grad = q.grad.clone(), None
-    tri_dk, k.grad = k.grad.clone(), None
-    tri_dv, v.grad = v.grad.clone(), None
+    tri_dq, q.grad = q.grad, None
+    tri_dk, k.grad = k.grad, None
+    tri_dv, v.grad = v.grad, None
     if use_forget_gate:
-        tri_dg, g.grad = g.grad.clone(), None
-    tri_dw, w.grad = w.grad.clone(), None
-    tri_db, beta.grad = beta.grad.clone(), None
+        tri_dg, g.grad = g.grad, None
+    tri_dw, w.grad = w.grad, None
+    tri_db, beta.grad = beta.grad, None
 
     assert_close(" o", ref, tri, 0.005)
     assert_close("dq", ref_dq, tri_dq, 0.008)
@@ -163,7 +206,9 @@ def test_parallel_varlen(
     torch.manual_seed(42)
     os.environ['TRITON_F32_DEFAULT'] = 'ieee'
     T = cu_seqlens[-1]
-    cu_seqlens = torch.tensor(cu_seqlens, dtype=torch.int32, device=device)
+    seq_lens = [eos - bos for bos, eos in zip(cu_seqlens[:-1], cu_seqlens[1:])]
+    cu_seqlens = torch.tensor(cu_seqlens, dtype=torch.int32, pin_memory=torch.cuda.is_available())
+    cu_seqlens = cu_seqlens.to(device, non_blocking=True)
 
     q = torch.randn((1, T, HQ, D), dtype=dtype, device=device).requires_grad_(True)
     k = torch.randn((1, T, H, D), dtype=dtype, device=device).requires_grad_(True)
@@ -177,30 +222,34 @@ def test_parallel_varlen(
         g = None
     do = torch.randn((1, T, HQ, D), dtype=dtype, device=device)
     scale = D ** -0.5
-    ref = torch.zeros(1, T, HQ, D, device=device, dtype=dtype)
-    for bos, eos in zip(cu_seqlens[:-1], cu_seqlens[1:]):
-        g_segment = torch.zeros(1, eos - bos, HQ, device=device, dtype=torch.float) if g is None else g[:, bos:eos]
-        ref[:, bos:eos] = naive_path_attn(
-            q[:, bos:eos], k[:, bos:eos], v[:, bos:eos],
-            w[:, bos:eos], beta[:, bos:eos], g_segment, scale
-        )
+    # a single scan over all sequences, the offsets of each segment cancel out in `g_i - g_j`
+    g_cumsum = torch.zeros(1, T, HQ, device=device, dtype=torch.float) if g is None else g.cumsum(1)
+    # the sequences are padded to the longest one and computed in a single batched call,
+    # padded positions re-read the first token of their sequence, they come after all valid ones and are never attended to
+    o_t = torch.arange(max(seq_lens), device=device)
+    mask = o_t < torch.tensor(seq_lens, device=device)[:, None]
+    indices = torch.where(mask, cu_seqlens[:-1, None] + o_t, cu_seqlens[:-1, None])
+    ref = naive_path_attn(
+        q[0, indices], k[0, indices], v[0, indices], w[0, indices], beta[0, indices],
+        None, scale, g_cumsum=g_cumsum[0, indices]
+    )[mask].unsqueeze(0)
     ref.backward(do)
-    ref_dq, q.grad = q.grad.clone(), None
-    ref_dk, k.grad = k.grad.clone(), None
-    ref_dv, v.grad = v.grad.clone(), None
+    ref_dq, q.grad = q.grad, None
+    ref_dk, k.grad = k.grad, None
+    ref_dv, v.grad = v.grad, None
     if use_forget_gate:
-        ref_dg, g.grad = g.grad.clone(), None
-    ref_dw, w.grad = w.grad.clone(), None
-    ref_db, beta.grad = beta.grad.clone(), None
+        ref_dg, g.grad = g.grad, None
+    ref_dw, w.grad = w.grad, None
+    ref_db, beta.grad = beta.grad, None
     tri, _ = parallel_path_attention(q=q, k=k, v=v, w=w, beta=beta, g=g, scale=scale, cu_seqlens=cu_seqlens)
     tri.backward(do)
-    tri_dq, q.grad = q.grad.clone(), None
-    tri_dk, k.grad = k.grad.clone(), None
-    tri_dv, v.grad = v.grad.clone(), None
+    tri_dq, q.grad = q.grad, None
+    tri_dk, k.grad = k.grad, None
+    tri_dv, v.grad = v.grad, None
     if use_forget_gate:
-        tri_dg, g.grad = g.grad.clone(), None
-    tri_dw, w.grad = w.grad.clone(), None
-    tri_db, beta.grad = beta.grad.clone(), None
+        tri_dg, g.grad = g.grad, None
+    tri_dw, w.grad = w.grad, None
+    tri_db, beta.grad = beta.grad, None
     assert_close(" o", ref, tri, 0.005)
     assert_close("dq", ref_dq, tri_dq, 0.005)
     assert_close("dk", ref_dk, tri_dk, 0.005)